@@ -0,0 +1,525 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Export a site into a single archive and re-create it from that archive on
+another server.
+
+The archive is an uncompressed (or gzipped) tar stream with these members, in
+this order:
+
+- :data:`META_NAME` : a JSON description of the site and its source server
+- :data:`REQUIREMENTS_NAME` : the pinned versions of all Python packages
+- ``wheels/`` : a wheel for every package, so that the target server needs no
+  network access
+- ``site/`` : the project directory including media files and sqlite
+  databases
+- ``db/`` : a dump of a MySQL or PostgreSQL database, split into chunks of
+  :data:`CHUNK_SIZE` bytes
+
+Both commands read and write the archive sequentially, so it can be piped
+from one server to another::
+
+    $ getlino export-site foo - | ssh other sudo getlino import-site -
+
+"""
+
+import io
+import os
+import sys
+import grp
+import json
+import time
+import sqlite3
+import tarfile
+import subprocess
+import virtualenv
+import click
+
+from os.path import join
+from contextlib import contextmanager
+
+from .utils import FOUND_CONFIG_FILES, DEFAULTSECTION, USE_NGINX
+from .utils import BATCH_HELP, ASROOT_HELP
+from .utils import Installer, locked, site_lock_name, site_app, resource_limits
+from .registry import get_site, get_sites, register_site, package_versions
+from .pgbouncer import use_pgbouncer, setup_pgbouncer
+from .dbtune import tune_database
+from .startsite import setup_logdir, setup_nginx, site_slice
+from .clonesite import rewrite_site_files, read_db_setting, read_db_password
+from .worker import setup_worker
+
+META_NAME = 'getlino-bundle.json'
+REQUIREMENTS_NAME = 'requirements.txt'
+BUNDLE_VERSION = 1
+
+# The database dump is buffered in memory chunk by chunk because a tar member
+# must know its size before it is written.
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Packages installed by virtualenv itself.
+SKIPPED_PACKAGES = ('pip', 'setuptools', 'wheel', 'pkg-resources')
+
+# note that we double curly braces because we will run format() on these:
+DUMP_COMMANDS = {
+    'postgresql': "pg_dump --no-owner --no-privileges -h {db_host} -p {db_port} "
+                  "-U {db_user} {db_name}",
+    'mysql': "mysqldump --single-transaction -h {db_host} -P {db_port} "
+             "-u {db_user} {db_name}",
+}
+
+RESTORE_COMMANDS = {
+    'postgresql': "psql --quiet --set ON_ERROR_STOP=1 -h {db_host} -p {db_port} "
+                  "-U {db_user} {db_name}",
+    'mysql': "mysql -h {db_host} -P {db_port} -u {db_user} {db_name}",
+}
+
+
+def wheelhouse():
+    """Return the directory which caches the wheels of exported and imported
+    sites."""
+    pth = join(DEFAULTSECTION.get('backups_root'), 'wheels')
+    os.makedirs(pth, exist_ok=True)
+    return pth
+
+
+def db_env(pwd):
+    """Return the environment for running a database client with the given
+    password, which must not appear on the command line."""
+    env = dict(os.environ)
+    env.update(PGPASSWORD=pwd, MYSQL_PWD=pwd)
+    return env
+
+
+def env_python_version(envdir):
+    p = subprocess.run(
+        [join(envdir, 'bin', 'python'), '-c',
+         "import sys; print('%d.%d' % sys.version_info[:2])"],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return p.stdout.strip()
+
+
+def normalize(name):
+    return name.lower().replace('-', '_').replace('.', '_')
+
+
+def installed_packages(envdir):
+    """Return a list of `(name, version, location)` for the packages of a
+    virtualenv.  `location` is the source directory of editable installs and
+    `None` for other packages."""
+    pip = join(envdir, 'bin', 'pip')
+    p = subprocess.run([pip, 'list', '--format=json'], stdout=subprocess.PIPE,
+                       universal_newlines=True, check=True)
+    editable = subprocess.run(
+        [pip, 'list', '--editable', '--verbose', '--format=json'],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    locations = {}
+    for pkg in json.loads(editable.stdout):
+        locations[pkg['name']] = pkg.get('editable_project_location') \
+            or pkg.get('location')
+    return [(pkg['name'], pkg['version'], locations.get(pkg['name']))
+            for pkg in json.loads(p.stdout)
+            if pkg['name'].lower() not in SKIPPED_PACKAGES]
+
+
+def build_wheels(envdir, packages, wheeldir):
+    """Make sure that `wheeldir` has a wheel for every package and return
+    the list of their file names.
+
+    Wheels of released versions are kept between exports.  Those of editable
+    installs are rebuilt every time because their code may have changed.
+    """
+    def find(name, version):
+        prefix = "{}-{}-".format(normalize(name), normalize(version))
+        for fn in os.listdir(wheeldir):
+            if normalize(fn).startswith(prefix) and fn.endswith('.whl'):
+                return fn
+
+    pip = join(envdir, 'bin', 'pip')
+    wheels = []
+    for name, version, location in packages:
+        fn = find(name, version)
+        if fn and location:
+            os.remove(join(wheeldir, fn))
+            fn = None
+        if fn is None:
+            spec = location or "{}=={}".format(name, version)
+            subprocess.run([pip, 'wheel', '--quiet', '--no-deps',
+                            '--wheel-dir', wheeldir, spec],
+                           stdout=sys.stderr, check=True)
+            fn = find(name, version)
+            if fn is None:
+                raise click.ClickException(
+                    "pip built no wheel for {}=={}".format(name, version))
+        wheels.append(fn)
+    return wheels
+
+
+@contextmanager
+def sqlite_snapshot(dbfile, retries=10):
+    """Yield the size of a sqlite database file which may be copied while
+    inside this context.
+
+    We hold the write lock, so the file doesn't change meanwhile, and make
+    sure that the write-ahead log has been copied into it before.
+    """
+    con = sqlite3.connect(dbfile, timeout=60, isolation_level=None)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        for n in range(retries):
+            other = sqlite3.connect(dbfile, timeout=60)
+            try:
+                busy, log, done = other.execute(
+                    "PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            finally:
+                other.close()
+            if log == done:
+                break
+            # readers of an older snapshot keep the last frames in the log
+            time.sleep(1)
+        else:
+            raise click.ClickException(
+                "Could not checkpoint {} (busy readers)".format(dbfile))
+        yield os.path.getsize(dbfile)
+    finally:
+        con.execute("ROLLBACK")
+        con.close()
+
+
+def add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+@click.command('export-site')
+@click.argument('prjname')
+@click.argument('output', default='')
+@click.option('--compress/--no-compress', default=False,
+              help="Whether to gzip the archive (media files are mostly "
+                   "compressed already)")
+@click.option('--media/--no-media', default=True,
+              help="Whether to include the media files")
+def export_site(prjname, output, compress, media):
+    """
+    Write a site with its code, data and media into a single archive.
+
+    Arguments:
+
+    PRJNAME : The name of the site.
+
+    OUTPUT : The archive file to write, or "-" for stdout.  Default is
+    PRJNAME.tar in the backups root.
+
+    """
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+
+    def log(msg):
+        # stdout may be the archive
+        click.echo(msg, err=True)
+
+    projects_root = DEFAULTSECTION.get('projects_root')
+    local_prefix = DEFAULTSECTION.get('local_prefix')
+    env_link = DEFAULTSECTION.get('env_link')
+    project_dir = join(projects_root, local_prefix, prjname)
+    if not os.path.isdir(project_dir):
+        raise click.ClickException("No site {} in {}".format(
+            prjname, join(projects_root, local_prefix)))
+    envdir = os.path.realpath(join(project_dir, env_link))
+
+    site = get_site(prjname)
+    if site is None:
+        app = site_app(project_dir)
+        appname = app.nickname if app else ''
+        db_engine = DEFAULTSECTION.get('db_engine')
+        options = {}
+    else:
+        appname, db_engine, options = site.appname, site.db_engine, site.options
+
+    if not output:
+        output = join(DEFAULTSECTION.get('backups_root'),
+                      prjname + (".tar.gz" if compress else ".tar"))
+
+    started = time.time()
+    wheeldir = wheelhouse()
+    with locked(site_lock_name(prjname)):
+        packages = installed_packages(envdir)
+        log("Building wheels for {} packages in {}...".format(
+            len(packages), wheeldir))
+        with locked('wheelhouse'):
+            wheels = build_wheels(envdir, packages, wheeldir)
+
+        meta = dict(
+            version=BUNDLE_VERSION, prjname=prjname, appname=appname,
+            db_engine=db_engine, options=options, created=time.time(),
+            python=env_python_version(envdir), project_dir=project_dir,
+            envdir=envdir, log_root=DEFAULTSECTION.get('log_root'),
+            server_domain=DEFAULTSECTION.get('server_domain'),
+            local_prefix=local_prefix)
+
+        if output == '-':
+            fd = sys.stdout.buffer
+        else:
+            fd = open(output, 'wb')
+        excluded = set(['site/' + env_link, 'site/log'])
+        if not media:
+            excluded.add('site/media')
+
+        def skip(info):
+            if info.name in excluded or info.name.endswith(
+                    ('.db', '.db-wal', '.db-shm', '.pyc')):
+                return None
+            return info
+
+        try:
+            with tarfile.open(fileobj=fd, mode='w|gz' if compress else 'w|') as tar:
+                add_bytes(tar, META_NAME, json.dumps(meta, indent=2).encode())
+                add_bytes(tar, REQUIREMENTS_NAME, ''.join(
+                    "{}=={}\n".format(name, version)
+                    for name, version, location in packages).encode())
+                for fn in wheels:
+                    tar.add(join(wheeldir, fn), 'wheels/' + fn)
+                log("Adding {}...".format(project_dir))
+                tar.add(project_dir, 'site', filter=skip)
+                for entry in os.scandir(project_dir):
+                    if entry.name.endswith('.db') and entry.is_file():
+                        with sqlite_snapshot(entry.path) as size:
+                            info = tar.gettarinfo(entry.path, 'site/' + entry.name)
+                            info.size = size
+                            with open(entry.path, 'rb') as dbfd:
+                                tar.addfile(info, dbfd)
+                if db_engine in DUMP_COMMANDS:
+                    log("Dumping {} database...".format(db_engine))
+                    cmd = DUMP_COMMANDS[db_engine].format(
+                        db_host=DEFAULTSECTION.get('db_host'),
+                        db_port=DEFAULTSECTION.get('db_port'),
+                        db_user=read_db_setting(project_dir, 'USER', prjname),
+                        db_name=read_db_setting(project_dir, 'NAME', prjname))
+                    p = subprocess.Popen(
+                        cmd.split(), stdout=subprocess.PIPE,
+                        env=db_env(read_db_password(project_dir)))
+                    n = 0
+                    while True:
+                        data = p.stdout.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        add_bytes(tar, "db/dump.sql.{:04d}".format(n), data)
+                        n += 1
+                    if p.wait() != 0:
+                        raise click.ClickException(
+                            "{} failed with exit code {}".format(cmd, p.returncode))
+        finally:
+            if fd is not sys.stdout.buffer:
+                fd.close()
+    log("Exported {} to {} in {:.1f} seconds.".format(
+        prjname, output, time.time() - started))
+
+
+def is_inside(pth, root):
+    return pth == root or pth.startswith(root + os.sep)
+
+
+def check_member(info, dest):
+    """Refuse archive members which would be written outside of the
+    directory `dest`, including links pointing outside of it.
+
+    We don't use the extraction filters of :mod:`tarfile` because they
+    remove the group write permission.
+    """
+    if info.name.startswith('/') or '..' in info.name.split('/'):
+        raise click.ClickException("Invalid archive member {}".format(info.name))
+    root = os.path.realpath(dest)
+    # a link extracted before may point elsewhere
+    pth = join(os.path.realpath(os.path.dirname(join(dest, info.name))),
+               os.path.basename(info.name))
+    if not is_inside(pth, root):
+        raise click.ClickException("Invalid archive member {}".format(info.name))
+    if info.issym():
+        target = os.path.realpath(join(os.path.dirname(pth), info.linkname))
+    elif info.islnk():
+        target = os.path.realpath(join(dest, info.linkname))
+    else:
+        return
+    if not is_inside(target, root):
+        raise click.ClickException("Invalid link {} -> {}".format(
+            info.name, info.linkname))
+
+
+@click.command('import-site')
+@click.argument('archive')
+@click.argument('prjname', default='')
+@click.option('--batch/--no-batch', default=False, help=BATCH_HELP)
+@click.option('--asroot/--no-asroot', default=False, help=ASROOT_HELP)
+@click.pass_context
+def import_site(ctx, archive, prjname, batch, asroot):
+    """
+    Create a site from an archive written by getlino export-site.
+
+    Arguments:
+
+    ARCHIVE : The archive file, or "-" for stdin.
+
+    PRJNAME : The name for the new site. Default is the name of the exported
+    site.
+
+    """
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+
+    i = Installer(batch, asroot)
+    if archive == '-':
+        if not batch:
+            raise click.UsageError("Reading from stdin requires --batch")
+        fd = sys.stdin.buffer
+    else:
+        fd = ctx.with_resource(open(archive, 'rb'))
+    tar = ctx.with_resource(tarfile.open(fileobj=fd, mode='r|*'))
+    members = iter(tar)
+    info = next(members, None)
+    if info is None or info.name != META_NAME:
+        raise click.ClickException("{} is not a getlino bundle".format(archive))
+    meta = json.loads(tar.extractfile(info).read().decode())
+    if meta['version'] > BUNDLE_VERSION:
+        raise click.ClickException(
+            "Bundle version {} is not supported".format(meta['version']))
+    python = "{}.{}".format(*sys.version_info[:2])
+    if meta['python'] != python:
+        raise click.ClickException(
+            "The bundle has wheels for Python {}, but this server uses {}".format(
+                meta['python'], python))
+
+    srcname = meta['prjname']
+    prjname = prjname or srcname
+    db_engine = meta['db_engine']
+    projects_root = DEFAULTSECTION.get('projects_root')
+    local_prefix = DEFAULTSECTION.get('local_prefix')
+    env_link = DEFAULTSECTION.get('env_link')
+    project_dir = join(projects_root, local_prefix, prjname)
+    usergroup = DEFAULTSECTION.get('usergroup')
+    gid = grp.getgrnam(usergroup).gr_gid
+
+    ctx.with_resource(locked(site_lock_name(prjname)))
+
+    if not i.check_overwrite(project_dir):
+        raise click.Abort()
+    if not i.yes_or_no("OK to import {} from {} into {} ? [y or n]".format(
+            srcname, archive, project_dir)):
+        raise click.Abort()
+
+    started = time.time()
+    os.umask(0o002)
+    os.makedirs(project_dir)
+    envdir = join(project_dir, env_link)
+    wheeldir = wheelhouse()
+    reqfile = join(wheeldir, "{}-requirements.txt".format(prjname))
+    db_user = db_password = None
+    restore = None
+
+    def site_files_done():
+        # all files of the site are there, adapt them to this server
+        rewrite_site_files(project_dir, srcname, prjname, source=meta,
+                           replacements=[(meta['envdir'], envdir)])
+        return (read_db_setting(project_dir, 'USER', prjname),
+                read_db_password(project_dir))
+
+    click.echo("Reading {}...".format(archive))
+    for info in members:
+        if info.name == REQUIREMENTS_NAME:
+            with open(reqfile, 'wb') as rfd:
+                rfd.write(tar.extractfile(info).read())
+        elif info.name.startswith('wheels/'):
+            if not os.path.exists(join(wheeldir, info.name[7:])):
+                info.name = info.name[7:]
+                if info.islnk():
+                    info.linkname = info.linkname[7:]
+                check_member(info, wheeldir)
+                tar.extract(info, wheeldir)
+        elif info.name.startswith('site/'):
+            # the files belong to us and the user group of this server
+            info.name = info.name[5:]
+            if info.islnk():
+                info.linkname = info.linkname[5:]
+            info.uid, info.gid = os.getuid(), gid
+            info.uname = info.gname = ''
+            check_member(info, project_dir)
+            tar.extract(info, project_dir)
+        elif info.name.startswith('db/'):
+            if restore is None:
+                db_user, db_password = site_files_done()
+                i.setup_database(prjname, db_user, db_password, db_engine)
+                cmd = RESTORE_COMMANDS[db_engine].format(
+                    db_host=DEFAULTSECTION.get('db_host'),
+                    db_port=DEFAULTSECTION.get('db_port'),
+                    db_user=db_user, db_name=prjname)
+                restore = subprocess.Popen(
+                    cmd.split(), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                    env=db_env(db_password))
+            src = tar.extractfile(info)
+            while True:
+                data = src.read(1024 * 1024)
+                if not data:
+                    break
+                restore.stdin.write(data)
+    if restore is None:
+        db_user, db_password = site_files_done()
+        i.setup_database(prjname, db_user, db_password, db_engine)
+    else:
+        restore.stdin.close()
+        if restore.wait() != 0:
+            raise click.ClickException(
+                "Database restore failed with exit code {}".format(
+                    restore.returncode))
+    click.echo("Extracted {} in {:.1f} seconds.".format(
+        archive, time.time() - started))
+
+    if batch or click.confirm("Create local virtualenv in {}".format(envdir),
+                              default=True):
+        virtualenv.create_environment(envdir)
+    i.run_in_env(envdir, "pip install --no-index --find-links {} -r {}".format(
+        wheeldir, reqfile))
+    with i.override_batch(True):
+        i.precompile(envdir)
+
+    if asroot and use_pgbouncer() and db_engine == 'postgresql':
+        dbnames = [s.prjname for s in get_sites(db_engine='postgresql')]
+        dbnames.append(prjname)
+        with locked('pgbouncer'):
+            if setup_pgbouncer(i, set(dbnames), db_user, db_password):
+                i.must_reload('pgbouncer')
+
+    context = {}
+    context.update(DEFAULTSECTION)
+    context.update({
+        "prjname": prjname,
+        "project_dir": project_dir,
+        "server_domain": prjname + "." + DEFAULTSECTION.get('server_domain'),
+        "usergroup": usergroup,
+    })
+    options = dict(meta['options'])
+    options.update(imported_from="{}.{}".format(srcname, meta['server_domain']))
+    context.update(options.get('limits', {}))
+
+    os.chdir(project_dir)
+    if asroot:
+        i.run_in_env(envdir, "python manage.py collectstatic --noinput")
+        setup_logdir(i, context)
+        if USE_NGINX:
+            setup_nginx(i, context)
+        if options.get('worker'):
+            with i.override_batch(True):
+                setup_worker(
+                    i, context, envdir, options['worker'],
+                    slice=site_slice(prjname), limits=resource_limits(context))
+    register_site(prjname, meta['appname'], project_dir, db_engine, envdir,
+                  options, package_versions(envdir))
+
+    if asroot:
+        tune_database(i)
+
+    i.finish()
+    click.echo("Imported {} into {} in {:.1f} seconds.".format(
+        srcname, project_dir, time.time() - started))
@@ -6,6 +6,17 @@ import click
 
 from .configure import configure
 from .startsite import startsite
+from .clonesite import clonesite
+from .upgrade import upgrade
+from .registry import list_sites
+from .sqlite import sqlite
+from .memstat import memstat
+from .warmup import warmup
+from .status import status
+from .bundle import export_site, import_site
+from .fleet import fleet
+from .logstats import logstats
+from .permissions import fix_permissions
 
 
 @click.group()
@@ -15,6 +26,18 @@ def main():
 
 main.add_command(configure)
 main.add_command(startsite)
+main.add_command(clonesite)
+main.add_command(upgrade)
+main.add_command(list_sites)
+main.add_command(sqlite)
+main.add_command(memstat)
+main.add_command(warmup)
+main.add_command(status)
+main.add_command(export_site)
+main.add_command(import_site)
+main.add_command(fleet)
+main.add_command(logstats)
+main.add_command(fix_permissions)
 
 if __name__ == '__main__':
     main()
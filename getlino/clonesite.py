@@ -0,0 +1,234 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import re
+import sqlite3
+import click
+
+from os.path import join
+
+from .utils import FOUND_CONFIG_FILES, DEFAULTSECTION, USE_NGINX
+from .utils import BATCH_HELP, ASROOT_HELP
+from .utils import Installer, locked, site_lock_name, site_app
+from .utils import resource_limits
+from .registry import get_site, get_sites, register_site, package_versions
+from .pgbouncer import use_pgbouncer, setup_pgbouncer
+from .dbtune import tune_database
+from .startsite import setup_logdir, setup_nginx, site_slice
+from .worker import setup_worker
+
+# Files below a project directory which may contain the project name.  Other
+# files (media, sqlite databases, ...) are copied without looking at them.
+REWRITE_SUFFIXES = ('.py', '.ini', '.conf', '.cfg', '.sh', '.txt')
+
+
+def copy_tree(i, src, dst, hardlink=False):
+    """Copy `src` to `dst` as cheaply as the file system allows.
+
+    Regular files are cloned using reflinks where the file system supports
+    them (btrfs, xfs), otherwise they are copied.  With `hardlink`, files are
+    hard-linked instead, which is even faster but means that both copies share
+    the same file contents.
+    """
+    if hardlink:
+        p = i.runcmd(["cp", "-a", "--link", src, dst])
+    else:
+        p = i.runcmd(["cp", "-a", "--reflink=auto", src, dst])
+    if p is None or p.returncode:
+        raise click.ClickException("Failed to copy {} to {}".format(src, dst))
+
+
+def copy_sqlite(src, dst):
+    """Copy a sqlite database using the online backup API, which gives a
+    consistent copy even while the source site is running."""
+    source = sqlite3.connect(src)
+    target = sqlite3.connect(dst)
+    with target:
+        source.backup(target)
+    target.close()
+    source.close()
+
+
+def rewrite_site_files(project_dir, old, new, source=None, replacements=()):
+    """Replace references to project `old` by `new` in the text files of
+    `project_dir` and rename files whose name starts with the old project name.
+
+    `source` is a dict with the `project_dir`, `log_root`, `server_domain` and
+    `local_prefix` of the old project when it comes from another server.
+    `replacements` is a list of additional `(old, new)` strings to replace.
+    """
+    log_root = DEFAULTSECTION.get('log_root')
+    domain = DEFAULTSECTION.get('server_domain')
+    local_prefix = DEFAULTSECTION.get('local_prefix')
+    src = dict(project_dir=join(os.path.dirname(project_dir), old),
+               log_root=log_root, server_domain=domain,
+               local_prefix=local_prefix)
+    src.update(source or {})
+    replacements = list(replacements) + [
+        (src['project_dir'], project_dir),
+        (join(src['log_root'], old), join(log_root, new)),
+        ("{}.{}".format(src['local_prefix'], old),
+         "{}.{}".format(local_prefix, new)),
+        ("{}.{}".format(old, src['server_domain']),
+         "{}.{}".format(new, domain)),
+        (old + "_uwsgi", new + "_uwsgi"),
+        (old + "-uwsgi", new + "-uwsgi"),
+        (old + ".sock", new + ".sock"),
+    ]
+    quoted = re.compile(r"""(['"]){}\1""".format(re.escape(old)))
+
+    for root, dirs, files in os.walk(project_dir):
+        # don't descend into media, log and env (which are symlinks or data)
+        dirs[:] = [d for d in dirs
+                   if d not in ('media', 'log', DEFAULTSECTION.get('env_link'))]
+        for fn in files:
+            pth = join(root, fn)
+            if os.path.islink(pth):
+                continue
+            if fn.endswith(REWRITE_SUFFIXES):
+                with open(pth) as fd:
+                    content = fd.read()
+                changed = content
+                for a, b in replacements:
+                    changed = changed.replace(a, b)
+                changed = quoted.sub(r"\g<1>{}\g<1>".format(new), changed)
+                if changed != content:
+                    with open(pth, 'w') as fd:
+                        fd.write(changed)
+            if fn.startswith(old) and fn[len(old):len(old) + 1] in ('.', '_', '-'):
+                os.rename(pth, join(root, new + fn[len(old):]))
+
+
+def read_db_setting(project_dir, name, default=None):
+    """Return the given database setting (e.g. ``'USER'``) stored in the
+    settings of a site."""
+    pth = join(project_dir, 'settings.py')
+    if os.path.exists(pth):
+        with open(pth) as fd:
+            mo = re.search(r"""['"]{}['"]\s*:\s*['"](.*?)['"]""".format(name),
+                           fd.read())
+        if mo:
+            return mo.group(1)
+    return default
+
+
+def read_db_password(project_dir, default="1234"):
+    """Return the database password stored in the settings of a site."""
+    return read_db_setting(project_dir, 'PASSWORD', default)
+
+
+@click.command()
+@click.argument('srcname')
+@click.argument('prjname')
+@click.option('--batch/--no-batch', default=False, help=BATCH_HELP)
+@click.option('--asroot/--no-asroot', default=False, help=ASROOT_HELP)
+@click.option('--hardlink-media/--no-hardlink-media', default=False,
+              help="Hard-link the media files instead of copying them")
+@click.pass_context
+def clonesite(ctx, srcname, prjname, batch, asroot, hardlink_media):
+    """
+    Create a new Lino site as a copy of an existing one.
+
+    Arguments:
+
+    SRCNAME : The name of the existing site.
+
+    PRJNAME : The name for the new site.
+
+    """
+
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+
+    i = Installer(batch, asroot)
+
+    projects_root = DEFAULTSECTION.get('projects_root')
+    local_prefix = DEFAULTSECTION.get('local_prefix')
+    python_path_root = join(projects_root, local_prefix)
+    src_dir = join(python_path_root, srcname)
+    project_dir = join(python_path_root, prjname)
+    db_engine = DEFAULTSECTION.get('db_engine')
+    env_link = DEFAULTSECTION.get('env_link')
+
+    if not os.path.isdir(src_dir):
+        raise click.ClickException("No site {} in {}".format(srcname, python_path_root))
+
+    if not i.yes_or_no("OK to clone {} to {} ? [y or n]".format(src_dir, project_dir)):
+        raise click.Abort()
+
+    ctx.with_resource(locked(site_lock_name(prjname)))
+
+    if not i.check_overwrite(project_dir):
+        raise click.Abort()
+
+    os.umask(0o002)
+    os.makedirs(project_dir)
+
+    with i.override_batch(True):
+        for entry in os.scandir(src_dir):
+            dst = join(project_dir, entry.name)
+            if entry.name in (env_link, 'log'):
+                # symlinks to the virtualenv and the log directory are
+                # recreated below
+                continue
+            if entry.name.endswith('.db') and entry.is_file(follow_symlinks=False):
+                copy_sqlite(entry.path, dst)
+            else:
+                copy_tree(i, entry.path, dst,
+                          hardlink=hardlink_media and entry.name == 'media')
+
+    # The new site uses the same virtualenv as the source site.
+    envdir = os.path.realpath(join(src_dir, env_link))
+    os.symlink(envdir, join(project_dir, env_link))
+
+    rewrite_site_files(project_dir, srcname, prjname)
+
+    context = {}
+    context.update(DEFAULTSECTION)
+    context.update({
+        "prjname": prjname,
+        "project_dir": project_dir,
+        "server_domain": prjname + "." + DEFAULTSECTION.get('server_domain'),
+        "usergroup": DEFAULTSECTION.get('usergroup'),
+    })
+
+    db_password = read_db_password(src_dir)
+    i.clone_database(srcname, prjname, prjname, db_password, db_engine,
+                     source_user=read_db_setting(src_dir, 'USER', srcname))
+    if asroot and use_pgbouncer():
+        dbnames = [s.prjname for s in get_sites(db_engine='postgresql')]
+        dbnames.append(prjname)
+        with locked('pgbouncer'):
+            if setup_pgbouncer(i, set(dbnames), prjname, db_password):
+                i.must_reload('pgbouncer')
+
+    src = get_site(srcname)
+    if src is None:
+        app = site_app(src_dir)
+        appname = app.nickname if app else ''
+        options = {}
+    else:
+        appname, options = src.appname, src.options
+    options.update(cloned_from=srcname)
+    # the clone gets the same resource limits as the source site
+    context.update(options.get('limits', {}))
+
+    if asroot:
+        setup_logdir(i, context)
+        if USE_NGINX:
+            setup_nginx(i, context)
+        if options.get('worker'):
+            with i.override_batch(True):
+                setup_worker(
+                    i, context, envdir, options['worker'],
+                    slice=site_slice(prjname), limits=resource_limits(context))
+    register_site(prjname, appname, project_dir, db_engine, envdir, options,
+                  package_versions(envdir))
+
+    if asroot:
+        tune_database(i)
+
+    i.finish()
+    click.echo("Cloned {} to {}.".format(srcname, project_dir))
@@ -17,7 +17,12 @@ from os.path import join
 
 from .utils import CONFIG, CONF_FILES, FOUND_CONFIG_FILES, DEFAULTSECTION
 from .utils import DB_ENGINES, BATCH_HELP, ASROOT_HELP
-from .utils import Installer
+from .utils import PROCESS_MANAGERS
+from .utils import Installer, locked, resource_limits
+from .pgbouncer import use_pgbouncer, setup_pgbouncer
+from .registry import get_sites
+from .dbtune import tune_database
+from .tls import setup_tls
 
 
 CERTBOT_AUTO_RENEW = """
@@ -32,18 +37,22 @@ supervisorctl status | awk '{if ( $2 != "RUNNING" ) { print "ERROR: " $1 " is no
 echo "... OK"
 """
 
+SYSTEMD_HEALTHCHECK_SH = """
+#!/bin/bash
+# generated by getlino
+set -e  # exit on error
+echo -n "Checking systemd status: "
+systemctl list-units --state=failed --no-legend --plain 'lino-*.slice' '*-uwsgi.service' libreoffice.service | awk '{print "ERROR: " $1 " has failed"; exit 1}'
+echo "... OK"
+"""
+
 MONIT_CONF = """
 # generated by getlino
 check program status with path /usr/local/bin/healthcheck.sh
     if status != 0 then alert
 """
 
-LIBREOFFICE_SUPERVISOR_CONF = """
-# generated by getlino
-[program:libreoffice]
-command = libreoffice --accept="socket,host=127.0.0.1,port=8100;urp;" --nologo --headless --nofirststartwizard
-umask = 0002
-"""
+LIBREOFFICE_COMMAND = 'libreoffice --accept="socket,host=127.0.0.1,port=8100;urp;" --nologo --headless --nofirststartwizard'
 
 LOCAL_SETTINGS = """
 # generated by getlino
@@ -55,6 +64,33 @@ SERVER_EMAIL = 'noreply@{server_domain}'
 DEFAULT_FROM_EMAIL = 'noreply@{server_domain}'
 STATIC_ROOT = 'env/static'
 TIME_ZONE = "{time_zone}"
+
+# Tune sqlite3 databases.  In WAL mode readers don't block the writer and the
+# writer doesn't block readers.  busy_timeout lets a writer wait for another
+# one instead of failing with "database is locked".
+from django.db.backends.signals import connection_created
+
+def _tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA mmap_size={sqlite_mmap_size}")
+            cursor.execute("PRAGMA busy_timeout={sqlite_busy_timeout}")
+
+connection_created.connect(_tune_sqlite, dispatch_uid="getlino_sqlite")
+"""
+
+SQLITE_CRON = """
+# generated by getlino
+17 * * * * root {getlino} sqlite --batch
+47 3 * * 0 root {getlino} sqlite --batch --vacuum
+"""
+
+# The WebDAV locks of LibreOffice clients, shared by all sites.
+NGINX_WEBDAV_CONF = """
+# generated by getlino
+dav_ext_lock_zone zone=getlino:10m;
 """
 
 
@@ -112,6 +148,40 @@ add('--admin-name', 'Joe Dow', "The full name of the server administrator")
 add('--admin-email', 'joe@example.com',
     "The email address of the server administrator")
 add('--time-zone', 'Europe/Brussels', "The TIME_ZONE to set on new sites")
+add('--process-manager', 'supervisor',
+    "Which process manager runs the uwsgi and LibreOffice processes",
+    click.Choice(PROCESS_MANAGERS))
+add('--cpu-weight', '100', "Default systemd CPUWeight of new sites")
+add('--cpu-quota', '', "Default systemd CPUQuota of new sites (e.g. 200%)")
+add('--memory-high', '', "Default systemd MemoryHigh of new sites (e.g. 1G)")
+add('--memory-max', '', "Default systemd MemoryMax of new sites (e.g. 2G)")
+add('--io-weight', '100', "Default systemd IOWeight of new sites")
+add('--pgbouncer/--no-pgbouncer', False,
+    "Whether postgresql sites connect through a local PgBouncer")
+add('--pgbouncer-port', 6432, "Port of the local PgBouncer")
+add('--pgbouncer-max-connections', 80,
+    "Maximum number of server connections used by PgBouncer for all sites")
+add('--tune-db/--no-tune-db', True,
+    "Whether to tune the database server for the hardware and number of sites")
+add('--disk-type', 'auto', "Type of the disk holding the databases",
+    click.Choice(['auto', 'ssd', 'hdd']))
+add('--sqlite-mmap-size', 268435456,
+    "How many bytes of a sqlite3 database to access via memory mapping")
+add('--sqlite-busy-timeout', 5000,
+    "How many milliseconds a sqlite3 writer waits for a lock")
+add('--warmup-urls', '/',
+    "Space-separated URLs to request when warming up a site")
+add('--http2/--no-http2', True, "Whether https sites use HTTP/2")
+add('--tls-session-cache', '10m',
+    "Size of the TLS session cache shared by the nginx workers (empty to disable)")
+add('--tls-session-tickets/--no-tls-session-tickets', True,
+    "Whether nginx resumes TLS sessions using session tickets")
+add('--ocsp-stapling/--no-ocsp-stapling', True,
+    "Whether nginx sends the OCSP response of the certificate to clients")
+add('--ocsp-resolver', '',
+    "Name servers used by nginx for OCSP stapling (default is those of the system)")
+add('--webdav-auth/--no-webdav-auth', False,
+    "Whether users must authenticate for the webdav of new sites")
 
 
 def configure(ctx, batch, asroot,
@@ -119,7 +189,12 @@ def configure(ctx, batch, asroot,
               webdav, backups_root, log_root, usergroup,
               supervisor_dir, db_engine, db_port, db_host, env_link, repos_link,
               appy, redis, devtools, server_domain, https, monit,
-              admin_name, admin_email, time_zone):
+              admin_name, admin_email, time_zone, process_manager,
+              cpu_weight, cpu_quota, memory_high, memory_max, io_weight,
+              pgbouncer, pgbouncer_port, pgbouncer_max_connections,
+              tune_db, disk_type, sqlite_mmap_size, sqlite_busy_timeout,
+              warmup_urls, http2, tls_session_cache, tls_session_tickets,
+              ocsp_stapling, ocsp_resolver, webdav_auth):
     """
     Edit and/or create a configuration file and
     set up this machine to become a Lino production server
@@ -178,8 +253,9 @@ def configure(ctx, batch, asroot,
     if not i.yes_or_no("Okay to configure your system using above options? [y or n]"):
         raise click.Abort()
 
-    with open(conffile, 'w') as fd:
-        CONFIG.write(fd)
+    with locked('config'):
+        with open(conffile, 'w') as fd:
+            CONFIG.write(fd)
     click.echo("Wrote config file " + conffile)
 
     # pth = "/etc/default/nginx"
@@ -215,11 +291,15 @@ def configure(ctx, batch, asroot,
                 i.runcmd("apt-get upgrade")
 
     i.apt_install(
-        "git subversion python3 python3-dev python3-setuptools python3-pip supervisor")
+        "git subversion python3 python3-dev python3-setuptools python3-pip")
+    if DEFAULTSECTION.get('process_manager') == 'supervisor':
+        i.apt_install("supervisor")
 
     if asroot:
         i.apt_install("nginx uwsgi-plugin-python3")
         i.apt_install("logrotate")
+        if DEFAULTSECTION.getboolean('webdav'):
+            i.apt_install("libnginx-mod-http-dav-ext")
 
     if DEFAULTSECTION.getboolean('devtools'):
         i.apt_install("tidy swig graphviz sqlite3")
@@ -234,23 +314,53 @@ def configure(ctx, batch, asroot,
         if DEFAULTSECTION.get('db_engine') == e.name:
             i.apt_install(e.apt_packages)
 
+    if use_pgbouncer():
+        i.apt_install("pgbouncer")
+
     if DEFAULTSECTION.getboolean('appy'):
         i.apt_install("libreoffice python3-uno")
 
-    i.finish()
+    # install the system packages before we configure them, but restart
+    # the services only once at the end
+    if asroot:
+        i.run_apt_install()
 
     if DEFAULTSECTION.getboolean('monit'):
-        i.write_file('/usr/local/bin/healthcheck.sh', HEALTHCHECK_SH, executable=True)
-        i.write_file('/etc/monit/conf.d/lino.conf', MONIT_CONF)
+        if DEFAULTSECTION.get('process_manager') == 'systemd':
+            healthcheck = SYSTEMD_HEALTHCHECK_SH
+        else:
+            healthcheck = HEALTHCHECK_SH
+        i.write_file('/usr/local/bin/healthcheck.sh', healthcheck, executable=True)
+        if i.write_file('/etc/monit/conf.d/lino.conf', MONIT_CONF):
+            i.must_reload('monit')
 
     if DEFAULTSECTION.getboolean('appy'):
-        i.write_supervisor_conf(
-            'libreoffice.conf',
-            LIBREOFFICE_SUPERVISOR_CONF.format(**DEFAULTSECTION))
+        i.write_program_conf(
+            'libreoffice', LIBREOFFICE_COMMAND,
+            slice='lino-libreoffice.slice',
+            limits=resource_limits(DEFAULTSECTION))
+
+    if asroot and DEFAULTSECTION.getboolean('webdav'):
+        if i.write_file('/etc/nginx/conf.d/getlino-webdav.conf', NGINX_WEBDAV_CONF,
+                        mode=0o644):
+            i.must_reload('nginx')
 
     if DEFAULTSECTION.get('db_engine') == 'mysql':
         i.runcmd("mysql_secure_installation")
 
+    if asroot and use_pgbouncer():
+        dbnames = [s.prjname for s in get_sites(db_engine='postgresql')]
+        if setup_pgbouncer(i, dbnames):
+            i.must_restart('pgbouncer')
+
+    if asroot:
+        tune_database(i, restart=True)
+
+    if asroot and DEFAULTSECTION.get('db_engine') == 'sqlite3':
+        # cron ignores files which are writable by others than root
+        i.write_file('/etc/cron.d/getlino-sqlite', SQLITE_CRON.format(
+            getlino=shutil.which('getlino') or 'getlino'), mode=0o644)
+
     if DEFAULTSECTION.getboolean('https'):
         if shutil.which("certbot-auto"):
             click.echo("certbot-auto already installed")
@@ -264,6 +374,11 @@ def configure(ctx, batch, asroot,
                 i.runcmd("certbot-auto register --agree-tos -m {} -n".format(DEFAULTSECTION.get('admin_email')))
         if batch or click.confirm("Set up automatic certificate renewal ", default=True):
             i.runcmd(CERTBOT_AUTO_RENEW)
+        if asroot:
+            setup_tls(i)
+
+    # reload the services whose config files have changed
+    i.finish()
 
     click.echo("Lino server setup completed.")
 
@@ -0,0 +1,172 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import glob
+import click
+import collections
+
+from os.path import join
+
+from .utils import DEFAULTSECTION, find_sites
+from .registry import get_sites
+
+POSTGRESQL_CONF_DIRS = '/etc/postgresql/*/main/conf.d'
+MYSQL_CONF_DIR = '/etc/mysql/conf.d'
+
+# How many database connections we expect per site (uwsgi workers, cron
+# jobs, background workers and interactive sessions).
+CONNECTIONS_PER_SITE = 10
+
+# The number of sites is rounded up to a multiple of this, so that the
+# database server gets restarted only when a few more sites have been added.
+SITES_STEP = 10
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+TUNED_CONF = """
+# generated by getlino for {memory_mb} MB RAM, {cpus} CPUs, {disk} disk
+# and up to {sites} sites.  Don't edit, run `getlino configure` instead.
+{header}{settings}
+"""
+
+
+def memory_bytes():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def disk_is_ssd(pth):
+    """Return True if `pth` is on a non-rotational disk.  The disk type
+    can be forced using the `disk_type` option of getlino.conf."""
+    disk_type = DEFAULTSECTION.get('disk_type', 'auto')
+    if disk_type != 'auto':
+        return disk_type == 'ssd'
+    while not os.path.exists(pth):
+        pth = os.path.dirname(pth)
+    dev = os.stat(pth).st_dev
+    sysdir = '/sys/dev/block/{}:{}'.format(os.major(dev), os.minor(dev))
+    # for a partition the queue is in the directory of its disk
+    for fn in (join(sysdir, 'queue', 'rotational'),
+               join(sysdir, '..', 'queue', 'rotational')):
+        if os.path.exists(fn):
+            with open(fn) as fd:
+                return fd.read().strip() == '0'
+    return True
+
+
+def expected_sites(db_engine):
+    """Return the number of sites using the given database engine, rounded
+    up to the next multiple of :data:`SITES_STEP`."""
+    n = len(get_sites(db_engine=db_engine)) or len(list(find_sites()))
+    return SITES_STEP * max(1, -(-n // SITES_STEP))
+
+
+def size(n):
+    """Format a number of bytes for a database config file."""
+    if n >= GB and n % GB == 0:
+        return "{}GB".format(n // GB)
+    return "{}MB".format(max(1, n // MB))
+
+
+def max_connections(sites):
+    if DEFAULTSECTION.getboolean('pgbouncer', False):
+        # PgBouncer limits the number of server connections
+        return DEFAULTSECTION.getint('pgbouncer_max_connections', 80) + 20
+    return 20 + CONNECTIONS_PER_SITE * sites
+
+
+def postgresql_settings(memory, cpus, ssd, sites):
+    s = collections.OrderedDict()
+    connections = max_connections(sites)
+    shared_buffers = memory // 4
+    s['max_connections'] = connections
+    s['shared_buffers'] = size(shared_buffers)
+    s['effective_cache_size'] = size(memory * 3 // 4)
+    s['maintenance_work_mem'] = size(min(memory // 16, 2 * GB))
+    # every connection may use work_mem several times per query
+    s['work_mem'] = size(max(4 * MB, (memory - shared_buffers) // (connections * 3)))
+    s['wal_buffers'] = '16MB'
+    s['min_wal_size'] = '1GB'
+    s['max_wal_size'] = '4GB'
+    s['checkpoint_completion_target'] = 0.9
+    s['random_page_cost'] = 1.1 if ssd else 4
+    s['effective_io_concurrency'] = 200 if ssd else 2
+    s['max_worker_processes'] = max(8, cpus)
+    s['max_parallel_workers'] = cpus
+    s['max_parallel_workers_per_gather'] = max(1, cpus // 2)
+    s['log_checkpoints'] = 'on'
+    s['log_min_duration_statement'] = 1000
+    return s
+
+
+def mysql_settings(memory, cpus, ssd, sites):
+    s = collections.OrderedDict()
+    buffer_pool = memory // 2
+    s['max_connections'] = max_connections(sites)
+    s['innodb_buffer_pool_size'] = size(buffer_pool)
+    s['innodb_buffer_pool_instances'] = min(8, max(1, buffer_pool // GB))
+    s['innodb_log_file_size'] = size(min(buffer_pool // 4, GB))
+    s['innodb_log_buffer_size'] = '16MB'
+    s['innodb_flush_method'] = 'O_DIRECT'
+    s['innodb_io_capacity'] = 2000 if ssd else 200
+    s['innodb_flush_neighbors'] = 0 if ssd else 1
+    s['innodb_read_io_threads'] = max(4, cpus)
+    s['innodb_write_io_threads'] = max(4, cpus)
+    s['tmp_table_size'] = '64MB'
+    s['max_heap_table_size'] = '64MB'
+    s['slow_query_log'] = 1
+    s['long_query_time'] = 1
+    return s
+
+
+def tune_database(i, restart=False):
+    """Write a config file with settings for the database server, derived
+    from the hardware of this server and the number of sites.
+
+    When the file has changed, the database server gets restarted if
+    `restart` is True.  Otherwise we just say that a restart is pending
+    because it would interrupt all sites of the server.
+    """
+    db_engine = DEFAULTSECTION.get('db_engine')
+    if not DEFAULTSECTION.getboolean('tune_db', True):
+        return
+    if db_engine == 'postgresql':
+        dirs = glob.glob(POSTGRESQL_CONF_DIRS)
+        header = ''
+        settings_func = postgresql_settings
+        filename = 'getlino.conf'
+        data_dir = '/var/lib/postgresql'
+    elif db_engine == 'mysql':
+        dirs = [MYSQL_CONF_DIR] if os.path.isdir(MYSQL_CONF_DIR) else []
+        header = "[mysqld]\n"
+        settings_func = mysql_settings
+        filename = 'getlino.cnf'
+        data_dir = '/var/lib/mysql'
+    else:
+        return
+    if not dirs:
+        click.echo("Warning: Found no config directory for " + db_engine)
+        return
+
+    memory = memory_bytes()
+    cpus = os.cpu_count() or 1
+    ssd = disk_is_ssd(data_dir)
+    sites = expected_sites(db_engine)
+    settings = settings_func(memory, cpus, ssd, sites)
+    content = TUNED_CONF.format(
+        memory_mb=memory // MB, cpus=cpus, disk="SSD" if ssd else "HDD",
+        sites=sites, header=header,
+        settings='\n'.join(["{} = {}".format(k, v) for k, v in settings.items()]))
+    changed = False
+    with i.override_batch(True):
+        for d in dirs:
+            if i.write_file(join(d, filename), content, mode=0o644):
+                changed = True
+    if changed:
+        if restart:
+            # the service has the same name as the engine
+            i.must_restart(db_engine)
+        else:
+            click.echo("Run `sudo service {} restart` to apply the new "
+                       "database settings.".format(db_engine))
@@ -0,0 +1,129 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import time
+import shlex
+import threading
+import subprocess
+import click
+from concurrent.futures import ThreadPoolExecutor
+
+from os.path import join
+
+# Where ssh keeps the sockets of its master connections.  Every connection to
+# a host is multiplexed over the master connection, which stays open for a
+# while after the last command so that the next getlino fleet command doesn't
+# need a new handshake.
+CONTROL_DIR = os.path.expanduser('~/.cache/getlino/ssh')
+
+
+def read_inventory(pth):
+    """Return the hosts listed in the given file, one per line.  Empty lines
+    and lines starting with "#" are ignored."""
+    hosts = []
+    with open(pth) as fd:
+        for ln in fd:
+            ln = ln.split('#')[0].strip()
+            if ln:
+                hosts.append(ln)
+    return hosts
+
+
+def ssh_args(host, ssh_command='ssh', persist='10m'):
+    """Return the ssh command line (without the remote command) for the
+    given host, which is specified as ``[user@]host[:port]``."""
+    args = shlex.split(ssh_command) + [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath={}'.format(join(CONTROL_DIR, '%C')),
+        '-o', 'ControlPersist={}'.format(persist),
+        '-o', 'BatchMode=yes']
+    if host.count(':') == 1:
+        host, port = host.split(':')
+        args += ['-p', port]
+    return args + [host]
+
+
+def run_on_host(host, remote_cmd, ssh_command, persist, echo):
+    """Run `remote_cmd` on the given host and pass every line of its output
+    to `echo`.  Return a tuple `(host, returncode, seconds)`."""
+    started = time.time()
+    echo(host, "started")
+    p = subprocess.Popen(
+        ssh_args(host, ssh_command, persist) + [remote_cmd],
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, universal_newlines=True)
+    for ln in p.stdout:
+        echo(host, ln.rstrip('\n'))
+    p.wait()
+    seconds = time.time() - started
+    echo(host, "finished with exit code {} in {:.1f} seconds".format(
+        p.returncode, seconds))
+    return host, p.returncode, seconds
+
+
+@click.command(context_settings=dict(ignore_unknown_options=True))
+@click.argument('args', nargs=-1, required=True, type=click.UNPROCESSED)
+@click.option('--hosts', default='',
+              help="Comma-separated list of hosts ([user@]host[:port])")
+@click.option('--inventory', type=click.Path(exists=True),
+              help="File with one host per line")
+@click.option('--parallel', default=4,
+              help="Maximum number of hosts to work on at the same time")
+@click.option('--sudo/--no-sudo', default=True,
+              help="Whether to run getlino as root on the hosts")
+@click.option('--ssh-command', default='ssh',
+              help="The ssh client to use, with additional options")
+@click.option('--persist', default='10m',
+              help="How long idle ssh connections stay open for reuse")
+def fleet(args, hosts, inventory, parallel, sudo, ssh_command, persist):
+    """
+    Run a getlino command on many servers.
+
+    Every server is reached over a multiplexed ssh connection which stays
+    open for some time, so that subsequent getlino fleet commands start
+    without a new ssh handshake.  The output of every server is shown as it
+    arrives, prefixed by the host name.
+
+    Arguments:
+
+    ARGS : The getlino command to run on every host, with its options.
+    Commands which ask questions need their --batch option.
+
+    Example:
+
+      getlino fleet --inventory hosts.txt -- startsite noi first --batch --asroot
+
+    """
+    hostnames = [h.strip() for h in hosts.split(',') if h.strip()]
+    if inventory:
+        hostnames += read_inventory(inventory)
+    if not hostnames:
+        raise click.UsageError("No hosts given (use --hosts or --inventory)")
+
+    os.makedirs(CONTROL_DIR, mode=0o700, exist_ok=True)
+    remote_cmd = ' '.join(shlex.quote(a) for a in ('getlino',) + args)
+    if sudo:
+        remote_cmd = "sudo -n -H " + remote_cmd
+
+    echo_lock = threading.Lock()
+    width = max(len(h) for h in hostnames)
+
+    def echo(host, msg):
+        with echo_lock:
+            click.echo("{:<{}} | {}".format(host, width, msg))
+
+    click.echo("Run {} on {} hosts...".format(remote_cmd, len(hostnames)))
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+        results = list(pool.map(
+            lambda h: run_on_host(h, remote_cmd, ssh_command, persist, echo),
+            hostnames))
+
+    failed = [host for host, returncode, seconds in results if returncode]
+    for host, returncode, seconds in results:
+        click.echo("{:<{}} {:>6.1f}s {}".format(
+            host, width, seconds, "FAILED" if returncode else "ok"))
+    click.echo("Done in {:.1f} seconds.".format(time.time() - started))
+    if failed:
+        raise click.ClickException("Failed on {}".format(' '.join(failed)))
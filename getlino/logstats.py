@@ -0,0 +1,263 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import re
+import glob
+import gzip
+import json
+import hashlib
+import math
+import click
+import collections
+
+from os.path import join
+
+from .utils import FOUND_CONFIG_FILES, DEFAULTSECTION, locked, find_sites
+from .registry import get_sites
+
+ACCESS_LOG_CONF = '/etc/nginx/conf.d/getlino-log.conf'
+
+# The format of the access logs of the sites.  $uri is the last field because
+# it may contain spaces.
+ACCESS_LOG_CONF_CONTENT = """
+# generated by getlino
+log_format getlino '$time_iso8601 $status $request_time $request_method $uri';
+"""
+
+ACCESS_LOG = 'access.log'
+
+# Where `getlino logstats --incremental` remembers how far it has read every
+# log file.
+STATE_FILENAME = 'logstats.json'
+
+# The endpoints of a site are counted separately up to this number, further
+# endpoints are counted together.
+MAX_ENDPOINTS = 500
+OTHER = '(other)'
+
+# Directories whose files are grouped into a single endpoint.
+FILE_PREFIXES = ('/static/', '/media/')
+
+
+class LatencySketch(object):
+    """A histogram of latencies with logarithmic buckets.
+
+    Every bucket covers values up to :attr:`GAMMA` times bigger than the
+    previous bucket, so the quantiles have a relative error of about 2% and
+    latencies between 1 millisecond and one hour need less than 400 buckets
+    however many requests we count.
+    """
+    GAMMA = 1.04
+
+    def __init__(self, buckets=None):
+        self.buckets = collections.Counter(buckets or {})
+        self.count = sum(self.buckets.values())
+
+    def add(self, seconds):
+        ms = max(seconds * 1000, 1.0)
+        self.buckets[int(math.ceil(math.log(ms, self.GAMMA)))] += 1
+        self.count += 1
+
+    def quantile(self, q):
+        """Return the latency (in seconds) below which the fraction `q` of
+        the values are."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if seen > rank:
+                # the middle of the bucket
+                return 2 * self.GAMMA ** k / (self.GAMMA + 1) / 1000
+        return None
+
+
+class SiteStats(object):
+    def __init__(self):
+        self.total = LatencySketch()
+        self.errors = 0
+        self.endpoints = {}
+
+    def add(self, status, seconds, uri):
+        self.total.add(seconds)
+        if status >= 500:
+            self.errors += 1
+        endpoint = normalize_uri(uri)
+        sketch = self.endpoints.get(endpoint)
+        if sketch is None:
+            if len(self.endpoints) >= MAX_ENDPOINTS:
+                endpoint = OTHER
+                sketch = self.endpoints.get(OTHER)
+            if sketch is None:
+                sketch = self.endpoints[endpoint] = LatencySketch()
+        sketch.add(seconds)
+
+
+def normalize_uri(uri):
+    """Return the endpoint of a request, i.e. its path with numeric
+    segments (primary keys) replaced by "*"."""
+    for prefix in FILE_PREFIXES:
+        if uri.startswith(prefix):
+            return prefix + '...'
+    return re.sub(r'/\d+(?=/|$)', '/*', uri)
+
+
+def parse_line(ln):
+    """Return a tuple `(status, seconds, uri)` for a line of an access log, or
+    `None` if it has an unknown format."""
+    parts = ln.rstrip('\n').split(' ', 4)
+    if len(parts) != 5:
+        return None
+    try:
+        return int(parts[1]), float(parts[2]), parts[4]
+    except ValueError:
+        return None
+
+
+def open_log(pth):
+    """Open a log file for reading bytes, decompressing it if needed."""
+    if pth.endswith('.gz'):
+        return gzip.open(pth, 'rb')
+    return open(pth, 'rb')
+
+
+def log_head(pth):
+    """Return a fingerprint of the first line of a log file, or `None` if it
+    has no complete line yet.
+
+    Compressing a rotated log file gives it a new inode, so we recognize it
+    by its first line.
+    """
+    with open_log(pth) as fd:
+        ln = fd.readline()
+    if ln.endswith(b'\n'):
+        return hashlib.sha1(ln).hexdigest()
+    return None
+
+
+def read_lines(pth, offset=0):
+    """Yield the complete lines of a log file starting at the given offset,
+    followed by the offset after the last complete line.
+
+    Compressed files are decompressed while reading them, and `offset`
+    counts the decompressed bytes.
+    """
+    with open_log(pth) as fd:
+        fd.seek(offset)
+        for ln in fd:
+            if not ln.endswith(b'\n'):
+                # the web server is writing this line right now
+                break
+            offset += len(ln)
+            yield ln.decode(errors='replace')
+    yield offset
+
+
+def log_files(prjname):
+    """Return the access log files of a site, oldest first."""
+    logdir = join(DEFAULTSECTION.get('log_root'), prjname)
+
+    def age(pth):
+        suffix = pth[len(join(logdir, ACCESS_LOG)):].strip('.').split('.')[0]
+        return int(suffix) if suffix.isdigit() else 0
+
+    return sorted(glob.glob(join(logdir, ACCESS_LOG + '*')), key=age,
+                  reverse=True)
+
+
+def fmt(seconds):
+    return "-" if seconds is None else "{:.3f}".format(seconds)
+
+
+@click.command()
+@click.argument('prjnames', nargs=-1)
+@click.option('--incremental/--no-incremental', default=False,
+              help="Read only what has been logged since the last "
+                   "incremental run")
+@click.option('--top', default=10,
+              help="How many of the slowest endpoints to show per site")
+@click.option('--min-requests', default=5,
+              help="Ignore endpoints with less requests")
+def logstats(prjnames, incremental, top, min_requests):
+    """
+    Show the number of requests and the latency of the sites.
+
+    Read the access logs of the sites (including the compressed rotated
+    ones) and show, for every site and its slowest endpoints, the number of
+    requests and the 50th, 95th and 99th percentile of the response time in
+    seconds.
+
+    Arguments:
+
+    PRJNAMES : The sites to show. Default is all sites.
+
+    """
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+    names = [s.prjname for s in get_sites(prjnames)] \
+        or [n for n, d in find_sites() if not prjnames or n in prjnames]
+    state_file = join(DEFAULTSECTION.get('log_root'), STATE_FILENAME)
+
+    with locked('logstats'):
+        state = {}
+        if incremental and os.path.exists(state_file):
+            with open(state_file) as fd:
+                state = json.load(fd)
+        for prjname in names:
+            stats = SiteStats()
+            # offsets by inode: rotation renames the files but keeps their
+            # inode, compression gives them a new one
+            offsets = state.get(prjname)
+            new_offsets = state[prjname] = {}
+            for pth in log_files(prjname):
+                key = str(os.stat(pth).st_ino)
+                head = log_head(pth)
+                offset = 0
+                if incremental and offsets is not None:
+                    done = offsets.get(key)
+                    if pth.endswith('.gz'):
+                        if done is not None:
+                            # we have read it completely
+                            new_offsets[key] = done
+                            continue
+                        # a file which has been compressed since the last
+                        # run: continue where we stopped reading it
+                        for v in offsets.values():
+                            if isinstance(v, dict) and head and v['head'] == head:
+                                offset = v['offset']
+                    elif isinstance(done, dict) and done['head'] == head:
+                        offset = done['offset']
+                    elif isinstance(done, int):
+                        # state of an older getlino version
+                        offset = done
+                    if not pth.endswith('.gz') and offset > os.path.getsize(pth):
+                        offset = 0
+                for ln in read_lines(pth, offset):
+                    if isinstance(ln, int):
+                        new_offsets[key] = dict(offset=ln, head=head)
+                        break
+                    values = parse_line(ln)
+                    if values is not None:
+                        stats.add(*values)
+            show_stats(prjname, stats, top, min_requests)
+        if incremental:
+            with open(state_file, 'w') as fd:
+                json.dump(state, fd)
+
+
+def show_stats(prjname, stats, top, min_requests):
+    total = stats.total
+    click.echo("{}: {} requests, {} errors, p50 {} p95 {} p99 {}".format(
+        prjname, total.count, stats.errors, fmt(total.quantile(0.5)),
+        fmt(total.quantile(0.95)), fmt(total.quantile(0.99))))
+    endpoints = [(sketch.quantile(0.95), endpoint, sketch)
+                 for endpoint, sketch in stats.endpoints.items()
+                 if sketch.count >= min_requests]
+    endpoints.sort(key=lambda e: e[0], reverse=True)
+    for p95, endpoint, sketch in endpoints[:top]:
+        click.echo("  {:>7} {:>7} {:>7} {:>7}  {}".format(
+            sketch.count, fmt(sketch.quantile(0.5)), fmt(p95),
+            fmt(sketch.quantile(0.99)), endpoint))
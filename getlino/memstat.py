@@ -0,0 +1,92 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import click
+
+from .utils import FOUND_CONFIG_FILES, find_sites
+from .registry import get_sites
+
+# The fields of /proc/PID/smaps_rollup we use (in kB).
+SMAPS_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty',
+                'Private_Clean', 'Private_Dirty')
+
+
+def read_smaps(pid):
+    """Return a dict with the memory usage (in kB) of the given process."""
+    values = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as fd:
+        for ln in fd:
+            parts = ln.split()
+            if parts and parts[0].rstrip(':') in SMAPS_FIELDS:
+                values[parts[0].rstrip(':')] = int(parts[1])
+    return values
+
+
+def uwsgi_processes(prjname):
+    """Return a list of `(pid, ppid)` of the uwsgi processes of a site."""
+    ini = "{}_uwsgi.ini".format(prjname)
+    found = []
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, 'cmdline'), 'rb') as fd:
+                cmdline = fd.read().decode(errors='replace')
+            if 'uwsgi' not in cmdline or ini not in cmdline:
+                continue
+            with open(os.path.join(entry.path, 'stat')) as fd:
+                # the command name (2nd field) is in parentheses and may
+                # contain spaces
+                ppid = int(fd.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            # the process ended meanwhile
+            continue
+        found.append((int(entry.name), ppid))
+    return found
+
+
+@click.command()
+@click.argument('prjnames', nargs=-1)
+def memstat(prjnames):
+    """
+    Show the memory used by the uwsgi processes of the sites.
+
+    For every worker, "unique" is the memory used only by that process and
+    "shared" the memory it shares with other processes (e.g. the code loaded
+    by the master before forking).  PSS is the process' proportional share
+    of all its memory.  Values are in MB.
+
+    Arguments:
+
+    PRJNAMES : The sites to show. Default is all sites.
+
+    """
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+    names = [s.prjname for s in get_sites(prjnames)] \
+        or [n for n, d in find_sites() if not prjnames or n in prjnames]
+    for prjname in names:
+        procs = uwsgi_processes(prjname)
+        if not procs:
+            click.echo("{}: no uwsgi processes".format(prjname))
+            continue
+        pids = set([pid for pid, ppid in procs])
+        total_unique = total_pss = 0
+        click.echo("{}:".format(prjname))
+        for pid, ppid in sorted(procs):
+            try:
+                v = read_smaps(pid)
+            except OSError as e:
+                click.echo("  {}: {}".format(pid, e))
+                continue
+            unique = v.get('Private_Clean', 0) + v.get('Private_Dirty', 0)
+            shared = v.get('Shared_Clean', 0) + v.get('Shared_Dirty', 0)
+            total_unique += unique
+            total_pss += v.get('Pss', 0)
+            click.echo("  {:>8} {:<6} unique {:>7.1f} shared {:>7.1f} pss {:>7.1f}".format(
+                pid, "worker" if ppid in pids else "master",
+                unique / 1024, shared / 1024, v.get('Pss', 0) / 1024))
+        click.echo("  total    unique {:>7.1f} pss {:>7.1f}".format(
+            total_unique / 1024, total_pss / 1024))
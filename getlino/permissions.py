@@ -0,0 +1,155 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import grp
+import stat
+import time
+import click
+from concurrent.futures import ThreadPoolExecutor
+
+from os.path import join
+
+from .utils import FOUND_CONFIG_FILES, DEFAULTSECTION, BATCH_HELP
+from .utils import Installer, find_sites
+from .registry import get_sites
+
+# The permission bits needed for sharing the files with the web server.  We
+# only add missing bits and never add any for others, because the web
+# server is in the user group.  The group may write to a file when its owner
+# may, so read-only files (e.g. the objects of a git repository) stay
+# read-only.
+FILE_MODE = stat.S_IRUSR | stat.S_IRGRP
+DIR_MODE = stat.S_IRWXU | stat.S_IRWXG | stat.S_ISGID
+EXEC_MODE = stat.S_IXUSR | stat.S_IXGRP
+
+
+def fix_entry(pth, si, gid, dry_run):
+    """Give a file or directory the group `gid` and the permissions
+    required for sharing it with the web server.  Return True if something
+    had to be changed."""
+    imode = stat.S_IMODE(si.st_mode)
+    if stat.S_ISDIR(si.st_mode):
+        mode = imode | DIR_MODE
+    else:
+        mode = imode | FILE_MODE
+        if imode & stat.S_IWUSR:
+            mode |= stat.S_IWGRP
+        if imode & stat.S_IXUSR:
+            mode |= EXEC_MODE
+    if si.st_gid == gid and mode == imode:
+        return False
+    if not dry_run:
+        if si.st_gid != gid:
+            # chown may clear the setgid bit of a file, so we chmod after it
+            os.chown(pth, -1, gid, follow_symlinks=False)
+        os.chmod(pth, mode)
+    return True
+
+
+def fix_tree(root, gid, skip=(), dry_run=False):
+    """Fix the group owner and permissions of all files below `root`.
+
+    Symbolic links and the directories in `skip` are not followed.  Return
+    a tuple `(root, scanned, changed, errors, seconds)`.
+    """
+    started = time.time()
+    scanned, changed, errors = 1, 0, 0
+    if fix_entry(root, os.lstat(root), gid, dry_run):
+        changed += 1
+    todo = [root]
+    while todo:
+        try:
+            entries = list(os.scandir(todo.pop()))
+        except OSError:
+            errors += 1
+            continue
+        for entry in entries:
+            if entry.is_symlink() or entry.path in skip:
+                continue
+            scanned += 1
+            try:
+                si = entry.stat(follow_symlinks=False)
+                if fix_entry(entry.path, si, gid, dry_run):
+                    changed += 1
+            except OSError:
+                errors += 1
+                continue
+            if stat.S_ISDIR(si.st_mode):
+                todo.append(entry.path)
+    return root, scanned, changed, errors, time.time() - started
+
+
+def site_trees(prjnames=None):
+    """Return a list of `(root, skip)` for the directory trees of the given
+    sites which must be shared with the web server: their project
+    directories (including the media files), their log directories and the
+    code repositories of their virtualenvs."""
+    log_root = DEFAULTSECTION.get('log_root')
+    env_link = DEFAULTSECTION.get('env_link')
+    repos_root = DEFAULTSECTION.get('repositories_root')
+    sites = [(s.prjname, s.project_dir) for s in get_sites(prjnames)] \
+        or [(n, d) for n, d in find_sites() if not prjnames or n in prjnames]
+    trees = []
+    repos = set([repos_root]) if repos_root else set()
+    for prjname, project_dir in sites:
+        envdir = join(project_dir, env_link)
+        trees.append((project_dir, (envdir,)))
+        trees.append((join(log_root, prjname), ()))
+        if not repos_root:
+            repos.add(join(os.path.realpath(envdir),
+                           DEFAULTSECTION.get('repos_link')))
+    trees.extend([(pth, ()) for pth in sorted(repos)])
+    return [(root, skip) for root, skip in trees if os.path.isdir(root)]
+
+
+@click.command('fix-permissions')
+@click.argument('prjnames', nargs=-1)
+@click.option('--batch/--no-batch', default=False, help=BATCH_HELP)
+@click.option('--parallel', default=os.cpu_count() or 1,
+              help="Maximum number of directory trees to fix at the same time")
+@click.option('--dry-run/--no-dry-run', default=False,
+              help="Only count the files which need to be fixed")
+def fix_permissions(prjnames, batch, parallel, dry_run):
+    """
+    Fix the group owner and permissions of the files of the sites.
+
+    Walk the project, media, log and repository directories of the sites
+    and give every file and directory the user group of this server and the
+    group permissions needed for sharing them with the web server.  Only
+    entries which differ get changed.
+
+    Arguments:
+
+    PRJNAMES : The sites to fix. Default is all sites.
+
+    """
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+
+    i = Installer(batch)
+    usergroup = DEFAULTSECTION.get('usergroup')
+    gid = grp.getgrnam(usergroup).gr_gid
+    trees = site_trees(prjnames)
+    if not trees:
+        click.echo("No sites found.")
+        return
+    for root, skip in trees:
+        click.echo("- {}".format(root))
+    if not dry_run and not i.yes_or_no(
+            "Fix permissions of these {} directories for group {}? [y or n]".format(
+                len(trees), usergroup)):
+        raise click.Abort()
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+        futures = [pool.submit(fix_tree, root, gid, skip, dry_run)
+                   for root, skip in trees]
+        for f in futures:
+            root, scanned, changed, errors, seconds = f.result()
+            total += changed
+            click.echo("{}: {} {} of {} entries{} ({:.1f} seconds)".format(
+                root, "must fix" if dry_run else "fixed", changed, scanned,
+                ", {} errors".format(errors) if errors else "", seconds))
+    click.echo("{} {} entries.".format("Must fix" if dry_run else "Fixed", total))
@@ -0,0 +1,119 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import shutil
+
+from os.path import join
+
+from .utils import DEFAULTSECTION
+
+PGBOUNCER_DIR = '/etc/pgbouncer'
+PGBOUNCER_INI = join(PGBOUNCER_DIR, 'pgbouncer.ini')
+PGBOUNCER_USERLIST = join(PGBOUNCER_DIR, 'userlist.txt')
+
+# The port of the PostgreSQL server behind the pooler.
+POSTGRESQL_PORT = 5432
+
+# note that we double curly braces because we will run format() on this string:
+PGBOUNCER_CONF = """
+# generated by getlino
+[databases]
+{databases}
+
+[pgbouncer]
+listen_addr = 127.0.0.1
+listen_port = {pgbouncer_port}
+unix_socket_dir = /var/run/postgresql
+auth_type = md5
+auth_file = {userlist}
+pool_mode = transaction
+max_client_conn = {max_client_conn}
+default_pool_size = {pool_size}
+min_pool_size = 0
+reserve_pool_size = {reserve_pool_size}
+max_db_connections = {max_db_connections}
+server_idle_timeout = 60
+logfile = /var/log/postgresql/pgbouncer.log
+pidfile = /var/run/postgresql/pgbouncer.pid
+"""
+
+# Appended to the settings of a site which connects through PgBouncer.
+# Server-side cursors don't work with transaction pooling.
+SITE_SETTINGS = """
+# added by getlino: PgBouncer runs in transaction pooling mode
+if 'DATABASES' in globals():
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+"""
+
+
+def use_pgbouncer():
+    return DEFAULTSECTION.get('db_engine') == 'postgresql' \
+        and DEFAULTSECTION.getboolean('pgbouncer', False)
+
+
+def pool_sizes(number_of_sites):
+    """Return a dict with the pool sizes for the given number of sites.
+
+    The server connections given by `pgbouncer_max_connections` are shared
+    among the sites, and every site gets at least two of them.
+    """
+    total = DEFAULTSECTION.getint('pgbouncer_max_connections', 80)
+    number_of_sites = max(1, number_of_sites)
+    pool_size = max(2, total // number_of_sites)
+    return dict(
+        pool_size=pool_size,
+        reserve_pool_size=max(1, pool_size // 4),
+        max_db_connections=pool_size + max(1, pool_size // 4),
+        max_client_conn=max(100, 50 * number_of_sites))
+
+
+def read_userlist():
+    users = {}
+    if os.path.exists(PGBOUNCER_USERLIST):
+        with open(PGBOUNCER_USERLIST) as fd:
+            for ln in fd:
+                parts = ln.split()
+                if len(parts) == 2:
+                    users[parts[0].strip('"')] = parts[1].strip('"')
+    return users
+
+
+def write_userlist(users):
+    # The file contains passwords, so we don't use Installer.write_file(),
+    # which would make it readable for the web server.
+    content = ''.join(['"{}" "{}"\n'.format(u, p) for u, p in sorted(users.items())])
+    old_umask = os.umask(0o077)
+    try:
+        with open(PGBOUNCER_USERLIST, 'w') as fd:
+            fd.write(content)
+    finally:
+        os.umask(old_umask)
+    os.chmod(PGBOUNCER_USERLIST, 0o640)
+    shutil.chown(PGBOUNCER_USERLIST, user='postgres', group='postgres')
+
+
+def setup_pgbouncer(i, databases, user=None, pwd=None):
+    """Write the PgBouncer config for the given database names and add the
+    given user (if any) to its user list.
+
+    Return True if the config has changed and PgBouncer must be reloaded.
+    """
+    changed = False
+    if user is not None:
+        users = read_userlist()
+        if users.get(user) != pwd:
+            users[user] = pwd
+            write_userlist(users)
+            changed = True
+    context = dict(DEFAULTSECTION)
+    context.update(pool_sizes(len(databases)))
+    context.update(userlist=PGBOUNCER_USERLIST)
+    context.update(databases='\n'.join([
+        "{0} = host=127.0.0.1 port={1} dbname={0}".format(db, POSTGRESQL_PORT)
+        for db in sorted(databases)]))
+    with i.override_batch(True):
+        if i.write_file(PGBOUNCER_INI, PGBOUNCER_CONF.format(**context),
+                        mode=0o644):
+            changed = True
+    return changed
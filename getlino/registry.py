@@ -0,0 +1,226 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""The site registry, a small sqlite database which knows the Lino sites
+of this server.
+
+:cmd:`getlino startsite` registers every new site so that commands which
+operate on many sites don't need to walk the projects root and guess the
+application and virtualenv of each site.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import subprocess
+import click
+import collections
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from os.path import join
+
+from .utils import FOUND_CONFIG_FILES, DEFAULTSECTION, find_sites, site_app
+
+REGISTRY_FILENAME = 'getlino.sqlite'
+
+SiteInfo = collections.namedtuple('SiteInfo', (
+    'prjname', 'appname', 'project_dir', 'db_engine', 'envdir', 'options',
+    'versions', 'created', 'upgraded'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sites (
+    prjname TEXT PRIMARY KEY,
+    appname TEXT,
+    project_dir TEXT,
+    db_engine TEXT,
+    envdir TEXT,
+    options TEXT,
+    versions TEXT,
+    created REAL,
+    upgraded REAL
+);
+CREATE INDEX IF NOT EXISTS sites_appname ON sites (appname);
+CREATE INDEX IF NOT EXISTS sites_db_engine ON sites (db_engine);
+CREATE INDEX IF NOT EXISTS sites_envdir ON sites (envdir);
+"""
+
+
+def registry_file():
+    return join(DEFAULTSECTION.get('projects_root'), REGISTRY_FILENAME)
+
+
+@contextmanager
+def connect(readonly=False):
+    """Yield a connection to the site registry and commit when leaving the
+    context.
+
+    Writers create the registry if needed.  Readers open it read-only, so
+    that users who may not write to it can use it, and get `None` when it
+    doesn't exist yet.
+    """
+    pth = registry_file()
+    if readonly and not os.path.exists(pth):
+        yield None
+        return
+    try:
+        if readonly:
+            con = sqlite3.connect('file:{}?mode=ro'.format(quote(pth)),
+                                  uri=True, timeout=30)
+        else:
+            con = sqlite3.connect(pth, timeout=30)
+            con.executescript(SCHEMA)
+    except sqlite3.Error as e:
+        raise click.ClickException(
+            "Cannot open the site registry {}: {}".format(pth, e))
+    try:
+        with con:
+            yield con
+    except sqlite3.Error as e:
+        raise click.ClickException(
+            "Error in the site registry {}: {}".format(pth, e))
+    finally:
+        con.close()
+
+
+def row2site(row):
+    row = list(row)
+    row[5] = json.loads(row[5] or '{}')
+    row[6] = json.loads(row[6] or '{}')
+    return SiteInfo(*row)
+
+
+def package_versions(envdir):
+    """Return a dict with the versions of the Lino and Django packages
+    installed in the given virtualenv."""
+    pip = join(envdir, 'bin', 'pip')
+    if not os.path.exists(pip):
+        return {}
+    p = subprocess.run([pip, 'freeze'], stdout=subprocess.PIPE,
+                       stderr=subprocess.DEVNULL, universal_newlines=True)
+    versions = {}
+    for ln in p.stdout.splitlines():
+        if ln.startswith('-e '):
+            # editable install: "-e git+https://...@sha#egg=lino"
+            name = ln.split('#egg=')[-1]
+            version = ln.split('@')[-1].split('#')[0]
+        elif '==' in ln:
+            name, version = ln.split('==', 1)
+        else:
+            continue
+        if name.lower().startswith(('lino', 'django')):
+            versions[name] = version
+    return versions
+
+
+def register_site(prjname, appname, project_dir, db_engine, envdir,
+                  options=None, versions=None):
+    """Add or replace the given site in the registry."""
+    now = time.time()
+    with connect() as con:
+        con.execute(
+            "INSERT OR REPLACE INTO sites VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (prjname, appname, project_dir, db_engine,
+             os.path.realpath(envdir), json.dumps(options or {}),
+             json.dumps(versions or {}), now, now))
+
+
+def set_upgraded(prjname, versions):
+    """Record that the given site has been upgraded to the given package
+    versions."""
+    with connect() as con:
+        con.execute(
+            "UPDATE sites SET versions = ?, upgraded = ? WHERE prjname = ?",
+            (json.dumps(versions), time.time(), prjname))
+
+
+def get_site(prjname):
+    with connect(readonly=True) as con:
+        if con is None:
+            return None
+        row = con.execute(
+            "SELECT * FROM sites WHERE prjname = ?", (prjname,)).fetchone()
+    if row is not None:
+        return row2site(row)
+
+
+def get_sites(prjnames=None, appname=None, db_engine=None, envdir=None):
+    """Return a list of :class:`SiteInfo` for the registered sites which match
+    the given criteria."""
+    where = []
+    params = []
+    if prjnames:
+        where.append("prjname IN ({})".format(','.join('?' * len(prjnames))))
+        params.extend(prjnames)
+    if appname:
+        where.append("appname = ?")
+        params.append(appname)
+    if db_engine:
+        where.append("db_engine = ?")
+        params.append(db_engine)
+    if envdir:
+        where.append("envdir = ?")
+        params.append(os.path.realpath(envdir))
+    sql = "SELECT * FROM sites"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY prjname"
+    with connect(readonly=True) as con:
+        if con is None:
+            return []
+        return [row2site(row) for row in con.execute(sql, params)]
+
+
+def scan_sites():
+    """Register the sites found in the projects root which are not yet
+    registered.  Return the names of the newly registered sites."""
+    known = set([s.prjname for s in get_sites()])
+    found = []
+    for prjname, project_dir in find_sites():
+        if prjname in known:
+            continue
+        app = site_app(project_dir)
+        envdir = join(project_dir, DEFAULTSECTION.get('env_link'))
+        register_site(
+            prjname, app.nickname if app else '', project_dir,
+            DEFAULTSECTION.get('db_engine'), envdir,
+            dict(scanned=True), package_versions(envdir))
+        found.append(prjname)
+    return found
+
+
+@click.command('list')
+@click.option('--app', 'appname', default=None,
+              help="Show only sites running this application")
+@click.option('--db-engine', default=None,
+              help="Show only sites using this database engine")
+@click.option('--env', 'envdir', default=None,
+              help="Show only sites using this virtualenv")
+@click.option('--format', 'fmt', default='table',
+              type=click.Choice(['table', 'names', 'json']),
+              help="Output format")
+@click.option('--scan/--no-scan', default=False,
+              help="Register existing sites found in the projects root")
+def list_sites(appname, db_engine, envdir, fmt, scan):
+    """
+    List the Lino sites of this server.
+
+    """
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+    if scan:
+        for prjname in scan_sites():
+            click.echo("Registered existing site {}".format(prjname), err=True)
+    sites = get_sites(appname=appname, db_engine=db_engine, envdir=envdir)
+    if fmt == 'names':
+        for s in sites:
+            click.echo(s.prjname)
+    elif fmt == 'json':
+        click.echo(json.dumps([s._asdict() for s in sites], indent=2))
+    else:
+        for s in sites:
+            click.echo("{} {} {} {} {}".format(
+                s.prjname, s.appname, s.db_engine, s.envdir,
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(s.upgraded))))
@@ -0,0 +1,102 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import glob
+import time
+import sqlite3
+import click
+
+from os.path import join
+
+from .utils import FOUND_CONFIG_FILES, DEFAULTSECTION, BATCH_HELP
+from .utils import Installer, find_sites
+from .registry import get_sites
+
+
+def sqlite_sites(prjnames=None):
+    """Yield a tuple `(prjname, project_dir)` for every site which uses
+    sqlite3."""
+    sites = get_sites(prjnames, db_engine='sqlite3')
+    if sites:
+        for s in sites:
+            yield s.prjname, s.project_dir
+    elif DEFAULTSECTION.get('db_engine') == 'sqlite3':
+        for prjname, project_dir in find_sites():
+            if not prjnames or prjname in prjnames:
+                yield prjname, project_dir
+
+
+def fix_owner(dbfile):
+    """Give the -wal and -shm files of a database the same owner and mode as
+    the database file.
+
+    When we run as root, sqlite creates them owned by root, and the site
+    would then be unable to open its database.
+    """
+    si = os.stat(dbfile)
+    for fn in (dbfile + '-wal', dbfile + '-shm'):
+        if os.path.exists(fn):
+            os.chown(fn, si.st_uid, si.st_gid)
+            os.chmod(fn, si.st_mode & 0o777)
+
+
+def maintain(dbfile, vacuum=False):
+    """Checkpoint the WAL of a sqlite database and optionally vacuum it.
+
+    Return the number of seconds used.
+    """
+    started = time.time()
+    con = sqlite3.connect(dbfile, timeout=60)
+    try:
+        con.execute("PRAGMA busy_timeout={}".format(
+            DEFAULTSECTION.getint('sqlite_busy_timeout', 5000)))
+        con.execute("PRAGMA journal_mode=WAL")
+        if vacuum:
+            con.execute("VACUUM")
+        con.execute("PRAGMA optimize")
+        # TRUNCATE resets the WAL file to zero bytes
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        con.close()
+    fix_owner(dbfile)
+    return time.time() - started
+
+
+@click.command()
+@click.argument('prjnames', nargs=-1)
+@click.option('--batch/--no-batch', default=False, help=BATCH_HELP)
+@click.option('--vacuum/--no-vacuum', default=False,
+              help="Also rebuild the database files (takes a write lock)")
+def sqlite(prjnames, batch, vacuum):
+    """
+    Maintain the sqlite3 databases of the sites on this server.
+
+    Checkpoint the write-ahead log of every database and optionally
+    vacuum it.  getlino configure schedules this command via cron.
+
+    Arguments:
+
+    PRJNAMES : The sites to maintain. Default is all sites using sqlite3.
+
+    """
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+
+    i = Installer(batch)
+    dbfiles = []
+    for prjname, project_dir in sqlite_sites(prjnames):
+        dbfiles.extend(glob.glob(join(project_dir, '*.db')))
+    if not dbfiles:
+        click.echo("No sqlite3 databases found.")
+        return
+    if not i.yes_or_no("Maintain {} databases? [y or n]".format(len(dbfiles))):
+        raise click.Abort()
+    for dbfile in dbfiles:
+        try:
+            seconds = maintain(dbfile, vacuum)
+        except sqlite3.Error as e:
+            click.echo("{}: {}".format(dbfile, e))
+        else:
+            click.echo("{}: done in {:.1f} seconds".format(dbfile, seconds))
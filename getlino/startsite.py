@@ -2,6 +2,7 @@
 # License: BSD (see file COPYING for details)
 
 import os
+import re
 import shutil
 import virtualenv
 import click
@@ -11,7 +12,16 @@ from cookiecutter.main import cookiecutter
 
 from .utils import APPNAMES, FOUND_CONFIG_FILES, DEFAULTSECTION, USE_NGINX
 from .utils import DB_ENGINES, BATCH_HELP, ASROOT_HELP, REPOS_DICT, KNOWN_REPOS
-from .utils import Installer, check_usergroup
+from .utils import Installer, check_usergroup, same_content, resource_limits
+from .utils import locked, env_lock_name, site_lock_name, Site
+from .registry import register_site, package_versions, get_sites
+from .pgbouncer import use_pgbouncer, setup_pgbouncer
+from .pgbouncer import SITE_SETTINGS as PGBOUNCER_SITE_SETTINGS
+from .dbtune import tune_database
+from .warmup import prime_site
+from .worker import setup_worker, default_worker_processes
+from .tls import setup_tls, tune_tls
+from .logstats import ACCESS_LOG_CONF, ACCESS_LOG_CONF_CONTENT
 
 SITES_AVAILABLE = '/etc/nginx/sites-available'
 SITES_ENABLED = '/etc/nginx/sites-enabled'
@@ -32,16 +42,220 @@ LOGROTATE_CONF = """
         sharedscripts
 }}
 
+{log_root}/{prjname}/access.log {{
+        weekly
+        missingok
+        rotate 52
+        compress
+        delaycompress
+        notifempty
+        create 660 root www-data
+        su root www-data
+        sharedscripts
+        postrotate
+                [ -s /run/nginx.pid ] && kill -USR1 `cat /run/nginx.pid`
+        endscript
+}}
+
 """
 
-UWSGI_SUPERVISOR_CONF = """
-# generated by getlino
-[program:{prjname}-uwsgi]
-command = /usr/bin/uwsgi --ini {project_dir}/nginx/{prjname}_uwsgi.ini
-user = {usergroup}
-umask = 0002
+UWSGI_PRELOAD = """
+# added by getlino: load the application in the master process
+master = true
+lazy-apps = false
 """
 
+UWSGI_COMMAND = "/usr/bin/uwsgi --ini {project_dir}/nginx/{prjname}_uwsgi.ini"
+
+# Let nginx send the files of a site from the kernel's page cache instead of
+# streaming them through a uwsgi worker.
+# note that we double curly braces because we will run format() on this string:
+NGINX_FILES_CONF = """
+# generated by getlino, included by {prjname}.conf
+access_log {log_root}/{prjname}/access.log getlino;
+
+location /media/ {{
+    alias {project_dir}/media/;
+    sendfile on;
+    tcp_nopush on;
+    aio threads;
+}}
+"""
+
+# With webdav_auth, users must authenticate before they can read or write
+# webdav documents.  Use htpasswd to add users to the password file.
+WEBDAV_PASSWD_DIR = '/etc/nginx/getlino-webdav'
+
+NGINX_WEBDAV_AUTH_CONF = """
+    auth_basic "{prjname} webdav";
+    auth_basic_user_file {webdav_passwd_file};"""
+
+NGINX_WEBDAV_CONF = """
+location /media/webdav/ {{
+    alias {project_dir}/media/webdav/;{webdav_auth}
+    sendfile on;
+    tcp_nopush on;
+    aio threads;
+    client_max_body_size 0;
+    create_full_put_path on;
+    dav_methods PUT DELETE MKCOL COPY MOVE;
+    dav_ext_methods PROPFIND OPTIONS LOCK UNLOCK;
+    dav_ext_lock zone=getlino;
+    dav_access user:rw group:rw;
+}}
+"""
+
+# The locations of the cookiecutter config which are replaced by those of
+# NGINX_FILES_CONF.
+NGINX_FILES_LOCATIONS = ('/media/', '/media/webdav/')
+
+
+def remove_locations(content, paths):
+    """Remove the `location` blocks for the given `paths` from the nginx
+    config `content`."""
+    for path in paths:
+        rx = re.compile(r"^[ \t]*location\s+(?:\^~\s+)?{}\s*\{{".format(
+            re.escape(path)), re.MULTILINE)
+        m = rx.search(content)
+        while m:
+            depth = 0
+            end = m.end() - 1
+            while end < len(content):
+                if content[end] == '{':
+                    depth += 1
+                elif content[end] == '}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                end += 1
+            content = content[:m.start()] + content[end + 1:].lstrip('\n')
+            m = rx.search(content)
+    return content
+
+
+def setup_webdav_passwd(pth, usergroup):
+    """Create an empty password file for the webdav of a site unless it
+    exists.  Nobody can use webdav until users have been added to it.
+
+    The file must be readable by nginx but not writable by the web server
+    group, and it is outside of the project directory because that one is
+    writable by the group.
+    """
+    if os.path.exists(pth):
+        return
+    os.makedirs(WEBDAV_PASSWD_DIR, mode=0o755, exist_ok=True)
+    with open(pth, 'w'):
+        pass
+    shutil.chown(pth, group=usergroup)
+    os.chmod(pth, 0o640)
+
+
+def tune_nginx_conf(i, context):
+    """Write the nginx config snippet for the media and webdav files of a
+    site and include it into the site's nginx config."""
+    prjname = context['prjname']
+    nginx_dir = join(context['project_dir'], 'nginx')
+    pth = join(nginx_dir, "{}.conf".format(prjname))
+    snippet = join(nginx_dir, "{}_files.conf".format(prjname))
+    files_conf = NGINX_FILES_CONF
+    webdav_auth = ''
+    if DEFAULTSECTION.getboolean('webdav'):
+        files_conf += NGINX_WEBDAV_CONF
+        os.makedirs(join(context['project_dir'], 'media', 'webdav'),
+                    exist_ok=True)
+        if DEFAULTSECTION.getboolean('webdav_auth'):
+            webdav_passwd_file = join(WEBDAV_PASSWD_DIR, prjname + '.htpasswd')
+            setup_webdav_passwd(webdav_passwd_file, context['usergroup'])
+            webdav_auth = NGINX_WEBDAV_AUTH_CONF.format(
+                webdav_passwd_file=webdav_passwd_file, **context)
+    with i.override_batch(True):
+        i.write_file(snippet, files_conf.format(
+            webdav_auth=webdav_auth, **context))
+    include = "include {};".format(snippet)
+    with open(pth) as fd:
+        content = fd.read()
+    if include in content:
+        return
+    content = remove_locations(content, NGINX_FILES_LOCATIONS)
+    content = re.sub(r"^([ \t]*)(server_name\s[^;]*;)",
+                     r"\1\2\n\1" + include, content, flags=re.MULTILINE)
+    with open(pth, 'w') as fd:
+        fd.write(content)
+
+
+def tune_uwsgi_ini(pth):
+    """Make sure that uwsgi loads the application in the master process
+    before forking the workers, so that they share its memory pages
+    copy-on-write."""
+    if not os.path.exists(pth):
+        return
+    with open(pth) as fd:
+        content = fd.read()
+    if UWSGI_PRELOAD in content:
+        return
+    # lazy-apps would load the application in every worker
+    lines = [ln for ln in content.splitlines()
+             if ln.split('=')[0].strip() not in ('lazy-apps', 'lazy', 'master')]
+    with open(pth, 'w') as fd:
+        fd.write('\n'.join(lines) + '\n' + UWSGI_PRELOAD)
+
+
+def site_slice(prjname):
+    """Return the name of the systemd slice for the processes of a site."""
+    return "lino-{}.slice".format(prjname)
+
+
+def setup_logdir(i, context):
+    """Create the log directory of a site and its logrotate entry."""
+    prjname = context['prjname']
+    logdir = join(DEFAULTSECTION.get("log_root"), prjname)
+    os.makedirs(logdir, exist_ok=True)
+    with i.override_batch(True):
+        i.check_permissions(logdir)
+        os.symlink(logdir, join(context['project_dir'], 'log'))
+
+        # add cron logrotate entry
+        i.write_file(
+            '/etc/logrotate.d/lino-{}.conf'.format(prjname),
+            LOGROTATE_CONF.format(**context))
+
+
+def setup_nginx(i, context):
+    """Install the nginx config file of a site and its uwsgi program."""
+    prjname = context['prjname']
+    server_domain = context['server_domain']
+    filename = "{}.conf".format(prjname)
+    avpth = join(SITES_AVAILABLE, filename)
+    enpth = join(SITES_ENABLED, filename)
+    with i.override_batch(True):
+        if i.write_file(ACCESS_LOG_CONF, ACCESS_LOG_CONF_CONTENT, mode=0o644):
+            i.must_reload("nginx")
+    tune_nginx_conf(i, context)
+    with open(join(context['project_dir'], 'nginx', filename)) as fd:
+        content = fd.read()
+    with i.override_batch(True):
+        if not same_content(avpth, content) and i.check_overwrite(avpth):
+            with open(avpth, 'w') as fd:
+                fd.write(content)
+            i.must_reload("nginx")
+        if os.path.realpath(enpth) != avpth and i.check_overwrite(enpth):
+            os.symlink(avpth, enpth)
+            i.must_reload("nginx")
+        i.write_program_conf(
+            '{}-uwsgi'.format(prjname), UWSGI_COMMAND.format(**context),
+            user=context['usergroup'], slice=site_slice(prjname),
+            limits=resource_limits(context),
+            reload_signal='HUP', kill_signal='SIGQUIT')
+    if DEFAULTSECTION.getboolean('https'):
+        i.runcmd("certbot-auto --nginx -d {} -d www.{}".format(server_domain,server_domain))
+        setup_tls(i)
+        with open(avpth) as fd:
+            content = fd.read()
+        tuned = tune_tls(content)
+        if tuned != content:
+            with open(avpth, 'w') as fd:
+                fd.write(tuned)
+        i.must_reload("nginx")
 
 
 @click.command()
@@ -51,8 +265,19 @@ umask = 0002
 @click.option('--asroot/--no-asroot', default=False, help=ASROOT_HELP)
 @click.option('--dev-repos', default='',
               help="List of packages for which to install development version")
+@click.option('--cpu-weight', default=None, help="systemd CPUWeight of this site")
+@click.option('--cpu-quota', default=None, help="systemd CPUQuota of this site")
+@click.option('--memory-high', default=None, help="systemd MemoryHigh of this site")
+@click.option('--memory-max', default=None, help="systemd MemoryMax of this site")
+@click.option('--io-weight', default=None, help="systemd IOWeight of this site")
+@click.option('--worker/--no-worker', default=False,
+              help="Whether to run a pool of background workers for this site")
+@click.option('--worker-processes', default=default_worker_processes(),
+              help="Number of background worker processes")
 @click.pass_context
-def startsite(ctx, appname, prjname, batch, asroot, dev_repos):
+def startsite(ctx, appname, prjname, batch, asroot, dev_repos,
+              cpu_weight, cpu_quota, memory_high, memory_max, io_weight,
+              worker, worker_processes):
     """
     Create a new Lino site.
 
@@ -68,7 +293,7 @@ def startsite(ctx, appname, prjname, batch, asroot, dev_repos):
         raise click.UsageError(
             "This server is not yet configured. Did you run `sudo -H getlino configure`?")
 
-    i = Installer(batch)
+    i = Installer(batch, asroot)
 
     # if os.path.exists(prjpath):
     #     raise click.UsageError("Project directory {} already exists.".format(prjpath))
@@ -106,6 +331,10 @@ def startsite(ctx, appname, prjname, batch, asroot, dev_repos):
                     "Allowed names are one or more of ({})".format(
                         k, nicknames))
 
+    # Other getlino processes may work on other sites meanwhile, but not on
+    # this one.
+    ctx.with_resource(locked(site_lock_name(prjname)))
+
     if not i.check_overwrite(project_dir):
         raise click.Abort()
 
@@ -113,6 +342,10 @@ def startsite(ctx, appname, prjname, batch, asroot, dev_repos):
         raise click.ClickException(
             "Cannot startsite in a development environment without a shared-env!")
 
+    if worker and not (asroot and DEFAULTSECTION.getboolean('redis')):
+        raise click.ClickException(
+            "A worker pool requires --asroot and a server with redis")
+
     usergroup = DEFAULTSECTION.get('usergroup')
 
     if check_usergroup(usergroup) or True:
@@ -153,6 +386,16 @@ sudo adduser `whoami` {0}"""
         "python_path": projects_root,
         "usergroup": usergroup
     })
+    # resource limits given on the command line override those of getlino.conf
+    limits = dict(cpu_weight=cpu_weight, cpu_quota=cpu_quota,
+                  memory_high=memory_high, memory_max=memory_max,
+                  io_weight=io_weight)
+    limits = {k: v for k, v in limits.items() if v is not None}
+    context.update(limits)
+    pgbouncer = asroot and use_pgbouncer()
+    if pgbouncer:
+        # the site connects to PgBouncer, not directly to the server
+        context.update(db_port=DEFAULTSECTION.get('pgbouncer_port'))
 
     click.echo(
         'Create a new Lino {appname} site into {project_dir}'.format(
@@ -190,17 +433,10 @@ sudo adduser `whoami` {0}"""
         COOKIECUTTER_URL,
         no_input=True, extra_context=context, output_dir=python_path_root)
 
-    if asroot:
-        logdir = join(DEFAULTSECTION.get("log_root"), prjname)
-        os.makedirs(logdir, exist_ok=True)
-        with i.override_batch(True):
-            i.check_permissions(logdir)
-            os.symlink(logdir, join(project_dir, 'log'))
+    tune_uwsgi_ini(join(project_dir, 'nginx', '{}_uwsgi.ini'.format(prjname)))
 
-            # add cron logrotate entry
-            i.write_file(
-                '/etc/logrotate.d/lino-{}.conf'.format(prjname),
-                LOGROTATE_CONF.format(**context))
+    if asroot:
+        setup_logdir(i, context)
 
     os.makedirs(join(project_dir, 'media'), exist_ok=True)
 
@@ -217,8 +453,11 @@ sudo adduser `whoami` {0}"""
         venv_msg = "Create local virtualenv in {}"
 
     if is_new_env:
-        if batch or click.confirm(venv_msg.format(envdir), default=True):
-            virtualenv.create_environment(envdir)
+        with locked(env_lock_name(envdir)):
+            # another getlino process might have created it meanwhile
+            if not os.path.exists(envdir):
+                if batch or click.confirm(venv_msg.format(envdir), default=True):
+                    virtualenv.create_environment(envdir)
 
     if shared_env:
         os.symlink(envdir, join(project_dir, DEFAULTSECTION.get('env_link')))
@@ -236,42 +475,70 @@ sudo adduser `whoami` {0}"""
     click.echo("Installing repositories ...".format(full_repos_dir))
     if dev_repos:
         os.chdir(full_repos_dir)
-        for nickname in dev_repos.split():
-            lib = REPOS_DICT.get(nickname, None)
-            if lib is None:
-                raise click.ClickException("Invalid repo nickname {}".format(nickname))
-            i.install_repo(lib)
+        with locked(env_lock_name(envdir)):
+            for nickname in dev_repos.split():
+                lib = REPOS_DICT.get(nickname, None)
+                if lib is None:
+                    raise click.ClickException("Invalid repo nickname {}".format(nickname))
+                i.install_repo(lib, envdir)
 
     for e in DB_ENGINES:
         if DEFAULTSECTION.get('db_engine') == e.name:
-            i.run_in_env(envdir, "pip install {}".format(e.python_packages))
+            i.pip_install(envdir, e.python_packages)
+
+    if worker:
+        with i.override_batch(True):
+            setup_worker(
+                i, context, envdir, worker_processes,
+                slice=site_slice(prjname), limits=resource_limits(context))
 
     if asroot:
         if USE_NGINX:
 
             if batch or click.confirm("Configure nginx", default=True):
-                filename = "{}.conf".format(prjname)
-                avpth = join(SITES_AVAILABLE, filename)
-                enpth = join(SITES_ENABLED, filename)
-                with i.override_batch(True):
-                    if i.check_overwrite(avpth):
-                        shutil.copyfile(join(project_dir, 'nginx', filename), avpth)
-                    if i.check_overwrite(enpth):
-                        os.symlink(avpth, enpth)
-                    i.must_restart("nginx")
-                    i.write_supervisor_conf('{}-uwsgi.conf'.format(prjname),
-                         UWSGI_SUPERVISOR_CONF.format(**context))
-                if DEFAULTSECTION.getboolean('https'):
-                    i.runcmd("certbot-auto --nginx -d {} -d www.{}".format(server_domain,server_domain))
-                    i.must_restart("nginx")
+                setup_nginx(i, context)
+
+    # a single pip run for the repositories, database driver and worker
+    i.run_pip_install()
 
     os.chdir(project_dir)
-    i.run_in_env(envdir, "python manage.py configure")
     i.setup_database(prjname, db_user, db_password, db_engine)
-    i.run_in_env(envdir, "python manage.py prep --noinput")
+    if pgbouncer:
+        with open(join(project_dir, 'settings.py'), 'a') as fd:
+            fd.write(PGBOUNCER_SITE_SETTINGS)
+        # pool sizes depend on the number of sites
+        dbnames = [s.prjname for s in get_sites(db_engine='postgresql')]
+        dbnames.append(prjname)
+        with locked('pgbouncer'):
+            if setup_pgbouncer(i, set(dbnames), db_user, db_password):
+                with i.override_batch(True):
+                    # reload now because prep connects through PgBouncer
+                    i.runcmd("service pgbouncer reload")
+
+    # configure may change what the site loads, so it runs in its own
+    # process.  Django and Lino get loaded only once for the other commands.
+    i.run_manage_commands(envdir, ['configure'])
+    commands = [['prep', '--noinput']]
+    if asroot:
+        commands.append(['collectstatic', '--noinput'])
+    commands.append(['buildcache'])
+    i.run_manage_commands(envdir, *commands)
+    with i.override_batch(True):
+        i.precompile(envdir, full_repos_dir)
+
+    register_site(
+        prjname, appname, project_dir, db_engine, envdir,
+        dict(dev_repos=dev_repos, shared_env=shared_env, asroot=asroot,
+             limits=limits, worker=worker_processes if worker else 0),
+        package_versions(envdir))
 
     if asroot:
-        i.run_in_env(envdir, "python manage.py collectstatic --noinput")
+        # the database server settings depend on the number of sites
+        tune_database(i)
 
     i.finish()
 
+    if asroot and USE_NGINX:
+        click.echo("Warming up uwsgi workers ...")
+        prime_site(Site(prjname, project_dir, envdir))
+
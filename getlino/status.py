@@ -0,0 +1,47 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import click
+
+from .utils import FOUND_CONFIG_FILES, program_is_running, find_sites
+from .registry import SiteInfo, get_sites
+from .worker import queue_stats
+
+
+def seconds(v):
+    return "-" if v is None else "{:.1f}s".format(v)
+
+
+@click.command()
+@click.argument('prjnames', nargs=-1)
+def status(prjnames):
+    """
+    Show the status of the sites on this server.
+
+    For every site show whether its uwsgi process is running and, for sites
+    with a worker pool, the number of waiting jobs, the age of the oldest
+    waiting job and the average wait and run time of recent jobs.
+
+    Arguments:
+
+    PRJNAMES : The sites to show. Default is all sites.
+
+    """
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+    sites = get_sites(prjnames)
+    if not sites:
+        # sites created by an older getlino version are not registered
+        sites = [SiteInfo(n, '', d, None, None, {}, {}, None, None)
+                 for n, d in find_sites() if not prjnames or n in prjnames]
+    for site in sites:
+        running = program_is_running("{}-uwsgi".format(site.prjname))
+        msg = "{}: {} {}".format(
+            site.prjname, site.appname, "running" if running else "NOT RUNNING")
+        if site.options.get('worker'):
+            q = queue_stats(site.prjname)
+            msg += ", queue {} jobs (oldest {}), wait {}, run {}".format(
+                q['depth'], seconds(q['oldest']), seconds(q['wait']),
+                seconds(q['run']))
+        click.echo(msg)
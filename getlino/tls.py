@@ -0,0 +1,125 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import re
+
+from .utils import DEFAULTSECTION
+
+TLS_SNIPPET = '/etc/nginx/snippets/getlino-tls.conf'
+
+RESOLV_CONF = '/etc/resolv.conf'
+
+# The options file which certbot includes into every server block it
+# secures.  Our snippet replaces it because nginx refuses duplicate ssl_*
+# directives.
+CERTBOT_OPTIONS = '/etc/letsencrypt/options-ssl-nginx.conf'
+
+# Intermediate compatibility as recommended by Mozilla.  The AES-GCM and
+# ChaCha20 ciphers are fast on all hardware, so we let the client choose
+# among them.
+TLS_PROTOCOLS = "TLSv1.2 TLSv1.3"
+TLS_CIPHERS = ":".join([
+    "ECDHE-ECDSA-AES128-GCM-SHA256", "ECDHE-RSA-AES128-GCM-SHA256",
+    "ECDHE-ECDSA-AES256-GCM-SHA384", "ECDHE-RSA-AES256-GCM-SHA384",
+    "ECDHE-ECDSA-CHACHA20-POLY1305", "ECDHE-RSA-CHACHA20-POLY1305"])
+
+
+def system_nameservers(pth=RESOLV_CONF):
+    """Return the name servers used by this system, in the syntax of the
+    nginx `resolver` directive."""
+    servers = []
+    if os.path.exists(pth):
+        with open(pth) as fd:
+            for ln in fd:
+                parts = ln.split()
+                if len(parts) > 1 and parts[0] == 'nameserver':
+                    # nginx wants IPv6 addresses in brackets
+                    servers.append(
+                        "[{}]".format(parts[1]) if ':' in parts[1] else parts[1])
+    return servers or ['127.0.0.53']
+
+
+def tls_conf():
+    """Return the content of the nginx TLS snippet for the settings in
+    getlino.conf."""
+    lines = ["# generated by getlino, included by the nginx config of every site.",
+             "# Don't edit, run `getlino configure` instead.",
+             "ssl_protocols {};".format(TLS_PROTOCOLS),
+             "ssl_ciphers {};".format(TLS_CIPHERS),
+             "ssl_prefer_server_ciphers off;",
+             "ssl_ecdh_curve X25519:prime256v1:secp384r1;"]
+    cache = DEFAULTSECTION.get('tls_session_cache', '10m')
+    if cache:
+        # about 4000 sessions per megabyte, shared by all nginx workers
+        lines.append("ssl_session_cache shared:getlino:{};".format(cache))
+        lines.append("ssl_session_timeout 1d;")
+    else:
+        lines.append("ssl_session_cache off;")
+    # nginx generates new ticket keys at every reload, which limits the
+    # impact of a compromised key.
+    lines.append("ssl_session_tickets {};".format(
+        "on" if DEFAULTSECTION.getboolean('tls_session_tickets', True) else "off"))
+    if DEFAULTSECTION.getboolean('ocsp_stapling', True):
+        # nginx finds the issuer certificate in the fullchain of certbot.  It
+        # needs a resolver for reaching the OCSP responder, and verifies its
+        # responses using the ssl_trusted_certificate of every server block.
+        resolver = DEFAULTSECTION.get('ocsp_resolver', '') \
+            or ' '.join(system_nameservers())
+        lines.append("ssl_stapling on;")
+        lines.append("ssl_stapling_verify on;")
+        lines.append("resolver {} valid=300s;".format(resolver))
+        lines.append("resolver_timeout 5s;")
+    # send small TLS records for the first bytes of a response
+    lines.append("ssl_buffer_size 4k;")
+    return "\n".join(lines) + "\n"
+
+
+def setup_tls(i):
+    """Write the nginx TLS snippet.  Return True if it has changed."""
+    with i.override_batch(True):
+        if i.write_file(TLS_SNIPPET, tls_conf(), mode=0o644):
+            i.must_reload('nginx')
+            return True
+    return False
+
+
+def tune_tls(content, snippet=TLS_SNIPPET):
+    """Return the nginx config `content` with our TLS snippet included into
+    every server block which listens on https.
+
+    Also enables or disables HTTP/2 on these servers, and tells nginx where
+    to find the chain of a certificate made by certbot for verifying OCSP
+    responses.
+    """
+    certbot = "include {};".format(CERTBOT_OPTIONS)
+    include = "include {};".format(snippet)
+    content = content.replace(certbot, include)
+    http2 = DEFAULTSECTION.getboolean('http2', True)
+    ocsp = DEFAULTSECTION.getboolean('ocsp_stapling', True)
+
+    def listen(m):
+        params = [p for p in m.group(2).split() if p != 'http2']
+        if http2:
+            params.insert(params.index('ssl') + 1, 'http2')
+        return "{}listen {};".format(m.group(1), ' '.join(params))
+
+    content = re.sub(r"^([ \t]*)listen\s+([^;]*\bssl\b[^;]*);", listen,
+                     content, flags=re.MULTILINE)
+
+    # certbot adds the ssl_certificate lines to the server blocks it
+    # secures, so we add our include after the last one where missing.
+    blocks = re.split(r"(?m)^(?=[ \t]*server\s*\{)", content)
+    for n, block in enumerate(blocks):
+        if 'ssl_certificate_key' not in block:
+            continue
+        if include not in block:
+            block = re.sub(r"(?m)^([ \t]*)(ssl_certificate_key\s[^;]*;)",
+                           r"\1\2\n\1" + include, block, count=1)
+        m = re.search(r"(?m)^[ \t]*ssl_certificate\s+(\S*)fullchain\.pem;", block)
+        if ocsp and m and 'ssl_trusted_certificate' not in block:
+            block = re.sub(r"(?m)^([ \t]*)({})$".format(re.escape(include)),
+                           r"\1\2\n\1ssl_trusted_certificate {}chain.pem;".format(
+                               m.group(1)), block, count=1)
+        blocks[n] = block
+    return ''.join(blocks)
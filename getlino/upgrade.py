@@ -0,0 +1,187 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import time
+import click
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from os.path import join
+
+from .utils import FOUND_CONFIG_FILES, DEFAULTSECTION, REPOS_DICT
+from .utils import BATCH_HELP
+from .utils import Installer, find_sites, site_app, SYSTEMD_DIR
+from .utils import process_manager, program_reload_cmd, program_is_running
+from .utils import locked, env_lock_name, site_lock_name
+from .utils import Site, run_site_commands
+from .registry import get_sites, set_upgraded, package_versions
+from .warmup import prime_site, site_is_ready
+
+
+def reload_uwsgi(i, site, timeout=60):
+    """Gracefully reload the uwsgi process of a site and wait until it
+    answers requests again."""
+    program = "{}-uwsgi".format(site.prjname)
+    i.runcmd(program_reload_cmd(program))
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        # the process manager reports the program as running while uwsgi is
+        # still loading the application
+        if program_is_running(program) and site_is_ready(site):
+            return True
+        time.sleep(1)
+    click.echo("Warning: {} is not ready after reload".format(program))
+    return False
+
+
+@click.command()
+@click.argument('prjnames', nargs=-1)
+@click.option('--batch/--no-batch', default=False, help=BATCH_HELP)
+@click.option('--parallel', default=os.cpu_count() or 1,
+              help="Maximum number of sites to migrate at the same time")
+@click.option('--reload-batch', default=1,
+              help="Maximum number of sites to reload at the same time")
+@click.option('--pull/--no-pull', default=True,
+              help="Whether to pull the development repositories")
+@click.option('--app', 'appname', default=None,
+              help="Upgrade only the sites running this application")
+@click.option('--warmup/--no-warmup', default=True,
+              help="Whether to build the caches and prime the workers")
+@click.pass_context
+def upgrade(ctx, prjnames, batch, parallel, reload_batch, pull, appname,
+            warmup):
+    """
+    Upgrade the Lino sites on this server.
+
+    Upgrade the Python packages of every virtualenv once, then migrate the
+    sites in parallel and finally reload their uwsgi processes a few at a
+    time.
+
+    Arguments:
+
+    PRJNAMES : The names of the sites to upgrade.  Default is all sites.
+
+    """
+
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+
+    i = Installer(batch)
+    env_link = DEFAULTSECTION.get('env_link')
+
+    sites = [Site(s.prjname, s.project_dir, s.envdir)
+             for s in get_sites(prjnames, appname)]
+    if not sites and not get_sites():
+        # no site has been registered yet, e.g. because they were created
+        # by an older getlino version
+        for prjname, project_dir in find_sites():
+            if prjnames and prjname not in prjnames:
+                continue
+            envdir = os.path.realpath(join(project_dir, env_link))
+            sites.append(Site(prjname, project_dir, envdir))
+    unknown = set(prjnames) - set([s.prjname for s in sites])
+    if unknown:
+        raise click.ClickException("Unknown sites {}".format(' '.join(unknown)))
+    if not sites:
+        click.echo("No sites to upgrade.")
+        return
+
+    envs = collections.OrderedDict()
+    for site in sites:
+        envs.setdefault(site.envdir, []).append(site)
+
+    click.echo("Upgrade {} sites in {} virtualenvs: {}".format(
+        len(sites), len(envs), ' '.join([s.prjname for s in sites])))
+    if not i.yes_or_no("OK to upgrade? [y or n]"):
+        raise click.Abort()
+
+    for site in sites:
+        ctx.with_resource(locked(site_lock_name(site.prjname)))
+
+    # the files created by pip and manage.py must stay writable for the
+    # user group, as in startsite
+    os.umask(0o002)
+
+    with i.override_batch(True):
+        for envdir, env_sites in envs.items():
+            packages = [REPOS_DICT[n].package_name for n in ("lino", "xl")]
+            for site in env_sites:
+                app = site_app(site.project_dir)
+                if app is not None and app.package_name \
+                        and app.package_name not in packages:
+                    packages.append(app.package_name)
+            repos_dir = DEFAULTSECTION.get('repositories_root') \
+                or join(envdir, DEFAULTSECTION.get('repos_link'))
+            with locked(env_lock_name(envdir)):
+                if pull and os.path.isdir(repos_dir):
+                    for entry in os.scandir(repos_dir):
+                        if os.path.isdir(join(entry.path, '.git')):
+                            i.runcmd("git -C {} pull".format(entry.path))
+                            # editable packages are upgraded by the pull
+                            repo = REPOS_DICT.get(entry.name)
+                            if repo is not None and repo.package_name in packages:
+                                packages.remove(repo.package_name)
+                if packages:
+                    i.run_in_env(envdir, "pip install -U {}".format(' '.join(packages)))
+            i.precompile(envdir, repos_dir)
+
+    # Migrate all sites in parallel, running the commands of every site in
+    # a single process.  collectstatic writes to the static directory of the
+    # virtualenv, so we run it only once per virtualenv.
+    jobs = []
+    for envdir, env_sites in envs.items():
+        for n, site in enumerate(env_sites):
+            commands = [['migrate', '--noinput']]
+            if warmup:
+                commands.append(['buildcache'])
+            if n == 0:
+                commands.append(['collectstatic', '--noinput'])
+            jobs.append((site, commands))
+
+    failed = set()
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+        futures = [pool.submit(run_site_commands, site, *commands)
+                   for site, commands in jobs]
+        for f in futures:
+            site, commands, returncode, output, seconds = f.result()
+            click.echo("{}: manage.py {} ({:.1f} seconds)".format(
+                site.prjname, ', '.join([c[0] for c in commands]), seconds))
+            if returncode:
+                click.echo(output)
+                failed.add(site.prjname)
+            else:
+                for ln in output.splitlines():
+                    if ln.startswith("getlino: "):
+                        click.echo("  " + ln[9:])
+
+    # Reload at most `reload_batch` sites at a time so that the other sites
+    # continue to serve requests.
+    if process_manager() == 'systemd':
+        can_reload = os.path.isdir(SYSTEMD_DIR)
+    else:
+        can_reload = os.path.isdir(DEFAULTSECTION.get('supervisor_dir'))
+    if can_reload:
+        to_reload = [s for s in sites if s.prjname not in failed]
+        step = max(1, reload_batch)
+        with i.override_batch(True), locked('services'):
+            for n in range(0, len(to_reload), step):
+                chunk = to_reload[n:n + step]
+                with ThreadPoolExecutor(max_workers=step) as pool:
+                    list(pool.map(lambda s: reload_uwsgi(i, s), chunk))
+                    if warmup:
+                        # don't degrade the next sites before these are
+                        # warm again
+                        list(pool.map(prime_site, chunk))
+
+    for envdir, env_sites in envs.items():
+        versions = package_versions(envdir)
+        for site in env_sites:
+            if site.prjname not in failed:
+                set_upgraded(site.prjname, versions)
+
+    if failed:
+        raise click.ClickException(
+            "Migration failed for {}".format(' '.join(sorted(failed))))
+    click.echo("Upgraded {} sites.".format(len(sites)))
@@ -3,12 +3,20 @@
 # License: BSD (see file COPYING for details)
 
 import os
+import re
+import glob
+import json
+import shlex
 import stat
+import fcntl
+import threading
 import shutil
 import grp
 import configparser
 import subprocess
+import time
 import click
+import functools
 import collections
 from contextlib import contextmanager
 
@@ -58,6 +66,90 @@ add("welfare", "lino-welfare", "", "https://github.com/lino-framework/welfare")
 
 APPNAMES = [a.nickname for a in KNOWN_REPOS if a.settings_module]
 
+# How to reload a service without interrupting the requests it is currently
+# serving.  Services not listed here are reloaded using `service X reload`.
+RELOAD_COMMANDS = {
+    'nginx': "nginx -t && nginx -s reload",
+    'supervisor': "supervisorctl reread && supervisorctl update",
+    'systemd': "systemctl daemon-reload",
+}
+
+PROCESS_MANAGERS = ['supervisor', 'systemd']
+SYSTEMD_DIR = '/etc/systemd/system'
+
+# Maps the resource limit options of getlino.conf to systemd directives.
+RESOURCE_LIMITS = collections.OrderedDict([
+    ('cpu_weight', 'CPUWeight'),
+    ('cpu_quota', 'CPUQuota'),
+    ('memory_high', 'MemoryHigh'),
+    ('memory_max', 'MemoryMax'),
+    ('io_weight', 'IOWeight'),
+])
+
+SUPERVISOR_PROGRAM_CONF = """
+# generated by getlino
+[program:{name}]
+command = {command}
+{options}umask = 0002
+"""
+
+SYSTEMD_SERVICE_CONF = """
+# generated by getlino
+[Unit]
+Description={name}
+After=network.target
+
+[Service]
+ExecStart={command}
+{options}UMask=0002
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+SYSTEMD_SLICE_CONF = """
+# generated by getlino
+[Slice]
+CPUAccounting=yes
+MemoryAccounting=yes
+IOAccounting=yes
+{options}"""
+
+# Runs several manage.py commands in a single Python process, so that Django
+# and the Lino site get loaded only once.  We let manage.py prepare the
+# environment as usual but replace the function it finally calls.  Argument
+# is a JSON list of commands, each of them a list of arguments.
+MANAGE_COMMANDS_SCRIPT = """
+import sys, json, time, runpy
+from django.core import management
+
+commands = json.loads(sys.argv[1])
+
+def run_commands(argv=None):
+    import django
+    started = time.time()
+    django.setup()
+    print("getlino: setup done in {:.1f} seconds".format(
+        time.time() - started), flush=True)
+    for args in commands:
+        started = time.time()
+        management.call_command(*args)
+        print("getlino: {} done in {:.1f} seconds".format(
+            ' '.join(args), time.time() - started), flush=True)
+
+management.execute_from_command_line = run_commands
+sys.argv = ['manage.py']
+runpy.run_path('manage.py', run_name='__main__')
+"""
+
+# Records the pip requests already satisfied in a virtualenv.
+PIP_CACHE_FILE = 'getlino-pip.json'
+
+# Where to create the lock files used to coordinate concurrent getlino
+# processes.
+LOCK_DIR = '/run/lock/getlino'
+
 CONF_FILES = ['/etc/getlino/getlino.conf',
               os.path.expanduser('~/.getlino.conf')]
 CONFIG = configparser.ConfigParser()
@@ -70,7 +162,10 @@ class Installer(object):
         self.batch = batch
         self.asroot = asroot
         self._services = set()
+        self._reload_services = set()
+        self._systemd_units = set()
         self._system_packages = set()
+        self._pip_packages = collections.OrderedDict()
 
     def check_overwrite(self, pth):
         """If pth (directory or file ) exists, remove it (after asking for confirmation).
@@ -103,35 +198,131 @@ class Installer(object):
                 return False
 
     def must_restart(self, srvname):
+        """Restart the given service when finishing."""
         self._services.add(srvname)
 
+    def must_reload(self, srvname):
+        """Reload the configuration of the given service when finishing.
+
+        Unlike a restart, a reload lets the service finish the requests it is
+        currently serving.
+        """
+        self._reload_services.add(srvname)
+
     def runcmd(self, cmd, **kw):
-        """Run the cmd similar as os.system(), but stop when Ctrl-C."""
+        """Run the cmd similar as os.system(), but stop when Ctrl-C.
+
+        `cmd` is either a string to be run by the shell or a list of
+        arguments to be run without shell.
+        """
         # kw.update(stdout=subprocess.PIPE)
         # kw.update(stderr=subprocess.STDOUT)
-        kw.update(shell=True)
+        kw.update(shell=isinstance(cmd, str))
         kw.update(universal_newlines=True)
         # subprocess.check_output(cmd, **kw)
-        if self.batch or click.confirm("run {}".format(cmd), default=True):
-            click.echo(cmd)
-            subprocess.run(cmd, **kw)
+        if not kw['shell']:
+            cmd_text = ' '.join(shlex.quote(a) for a in cmd)
+        else:
+            cmd_text = cmd
+        if self.batch or click.confirm("run {}".format(cmd_text), default=True):
+            click.echo(cmd_text)
+            return subprocess.run(cmd, **kw)
 
     def apt_install(self, packages):
         for pkg in packages.split():
             self._system_packages.add(pkg)
 
     def run_in_env(self, env, cmd):
-        """env is the path of the virtualenv"""
-        # click.echo(cmd)
-        cmd = ". {}/bin/activate && {}".format(env, cmd)
-        self.runcmd(cmd)
+        """Run `cmd` using the programs of the virtualenv in the directory
+        `env`.
+
+        We call the program of the virtualenv directly instead of sourcing
+        its activate script in a shell.
+        """
+        args = shlex.split(cmd)
+        if os.path.exists(join(env, 'bin', args[0])):
+            args[0] = join(env, 'bin', args[0])
+        if cmd.split()[0] == 'pip':
+            # pip must not run twice at the same time in a same env
+            with locked(env_lock_name(env)):
+                return self.runcmd(args, env=env_environ(env))
+        return self.runcmd(args, env=env_environ(env))
+
+    def run_manage_commands(self, env, *commands):
+        """Run the given :xfile:`manage.py` commands of the site in the
+        current directory one after the other in a single process.
+
+        Every command is a list of arguments, e.g. ``['prep', '--noinput']``.
+        """
+        return self.runcmd(manage_commands_args(env, commands),
+                           env=env_environ(env))
+
+    def pip_install(self, env, packages):
+        """Install the given Python packages into the virtualenv `env` when
+        :meth:`run_pip_install` is called.
+
+        `packages` is a string of requirement specifiers separated by
+        spaces.  ``-e`` followed by a directory requests an editable
+        install.
+        """
+        args = packages.split()
+        if not args:
+            return
+        pending = self._pip_packages.setdefault(env, [])
+        while args:
+            spec = args.pop(0)
+            if spec == '-e':
+                spec += ' ' + args.pop(0)
+            if spec not in pending:
+                pending.append(spec)
+
+    def run_pip_install(self):
+        """Install the Python packages requested by :meth:`pip_install`,
+        using a single pip process per virtualenv.
+
+        pip is not run at all when the same packages have been installed
+        before and the virtualenv hasn't changed since.  This is recorded in
+        the file :data:`PIP_CACHE_FILE` of the virtualenv.
+        """
+        for env, specs in self._pip_packages.items():
+            with locked(env_lock_name(env)):
+                cache_file = join(env, PIP_CACHE_FILE)
+                key = ' '.join(sorted(specs))
+                cache = {}
+                if os.path.exists(cache_file):
+                    with open(cache_file) as fd:
+                        cache = json.load(fd)
+                if cache.get(key) == site_packages_mtime(env):
+                    click.echo("Python packages {} are installed.".format(key))
+                    continue
+                p = self.run_in_env(env, "pip install {}".format(' '.join(specs)))
+                if p is not None and p.returncode == 0:
+                    cache[key] = site_packages_mtime(env)
+                    with open(cache_file, 'w') as fd:
+                        json.dump(cache, fd)
+        self._pip_packages = collections.OrderedDict()
+
+    def precompile(self, env, *dirs):
+        """Compile the Python files of the given virtualenv and of the given
+        directories to bytecode, using all CPUs.
+
+        Otherwise the first request to every uwsgi worker would have to
+        compile them.
+        """
+        dirs = glob.glob(join(env, 'lib', 'python*', 'site-packages')) \
+            + [d for d in dirs if os.path.isdir(d)]
+        if not dirs:
+            return
+        with locked(env_lock_name(env)):
+            self.run_in_env(
+                env, "python -m compileall -q -j 0 {}".format(' '.join(dirs)))
 
     def check_permissions(self, pth, executable=False):
         si = os.stat(pth)
 
         # check whether group owner is what we want
         usergroup = DEFAULTSECTION.get('usergroup')
-        if grp.getgrgid(si.st_gid).gr_name != usergroup:
+        if group_name(si.st_gid) != usergroup:
             if self.batch or click.confirm("Set group owner for {}".format(pth),
                                             default=True):
                 shutil.chown(pth, group=usergroup)
@@ -161,18 +352,93 @@ class Installer(object):
         finally:
             self.batch = old
 
-    def write_file(self, pth, content, **kwargs):
+    def write_file(self, pth, content, mode=None, **kwargs):
+        """Write `content` to the file `pth`.
+
+        The file gets the permissions required by :meth:`check_permissions`
+        unless an explicit `mode` is given (e.g. for files which must not be
+        group-writable).
+
+        Return True if the file has been written, False if the file already
+        had the given content or if the user refused to overwrite it.
+        """
+        if same_content(pth, content):
+            return False
         if self.check_overwrite(pth):
             with open(pth, 'w+') as fd:
                 fd.write(content)
-            with self.override_batch(True):
-                self.check_permissions(pth, **kwargs)
+            if mode is None:
+                with self.override_batch(True):
+                    self.check_permissions(pth, **kwargs)
+            else:
+                os.chmod(pth, mode)
             return True
+        return False
 
     def write_supervisor_conf(self, filename, content):
-        self.write_file(
-            join(DEFAULTSECTION.get('supervisor_dir'), filename), content)
-        self.must_restart('supervisor')
+        if self.write_file(
+                join(DEFAULTSECTION.get('supervisor_dir'), filename), content,
+                mode=0o644):
+            self.must_reload('supervisor')
+
+    def write_program_conf(self, name, command, user=None, slice=None,
+                           limits=None, reload_signal=None, kill_signal=None,
+                           directory=None, numprocs=1):
+        """Install a long-running program `name` into the process manager
+        configured in getlino.conf (supervisor or systemd).
+
+        With systemd, the program runs in the given `slice`, and the
+        resource `limits` (a dict of systemd directives as returned by
+        :func:`resource_limits`) apply to all programs of that slice.
+        Supervisor ignores the slice and the limits.
+
+        When `numprocs` is more than 1, the process manager runs that many
+        instances of the program (with systemd as instances of a template
+        unit ``name@.service``).
+        """
+        if process_manager() == 'systemd':
+            options = ''
+            if user:
+                options += "User={}\n".format(user)
+            if directory:
+                options += "WorkingDirectory={}\n".format(directory)
+            if slice:
+                options += "Slice={}\n".format(slice)
+            if reload_signal:
+                options += "ExecReload=/bin/kill -{} $MAINPID\n".format(reload_signal)
+            if kill_signal:
+                options += "KillSignal={}\n".format(kill_signal)
+            unitname = name + '@' if numprocs > 1 else name
+            changed = self.write_file(
+                join(SYSTEMD_DIR, unitname + '.service'),
+                SYSTEMD_SERVICE_CONF.format(**locals()), mode=0o644)
+            if slice:
+                options = ''.join(["{}={}\n".format(k, v)
+                                   for k, v in (limits or {}).items()])
+                if self.write_file(join(SYSTEMD_DIR, slice),
+                                   SYSTEMD_SLICE_CONF.format(options=options),
+                                   mode=0o644):
+                    # resource limits of a slice apply without restarting
+                    # its services
+                    self.must_reload('systemd')
+            if changed:
+                self.must_reload('systemd')
+                if numprocs > 1:
+                    for n in range(1, numprocs + 1):
+                        self._systemd_units.add("{}@{}.service".format(name, n))
+                else:
+                    self._systemd_units.add(name + '.service')
+        else:
+            options = ''
+            if user:
+                options += "user = {}\n".format(user)
+            if directory:
+                options += "directory = {}\n".format(directory)
+            if numprocs > 1:
+                options += "numprocs = {}\n".format(numprocs)
+                options += "process_name = %(program_name)s_%(process_num)02d\n"
+            self.write_supervisor_conf(
+                name + '.conf', SUPERVISOR_PROGRAM_CONF.format(**locals()))
 
     def setup_database(self, database, user, pwd, db_engine):
         if db_engine == 'sqlite3':
@@ -183,16 +449,55 @@ class Installer(object):
             run("create user '{user}'@'localhost' identified by '{pwd}'".format(**locals()))
             run("create database {database} charset 'utf8'".format(**locals()))
             run("grant all PRIVILEGES on {database}.* to '{user}'@'localhost'".format(**locals()))
-        elif db_engine == 'pgsql':
+        elif db_engine == 'postgresql':
             def run(cmd):
                 assert '"' not in cmd
-                self.runcmd('sudo -u postgres bash -c "psql -c \"{}\";"'.format(cmd))
+                self.runcmd('sudo -u postgres psql -c "{}"'.format(cmd))
             run("CREATE USER {user} WITH PASSWORD '{pwd}';".format(**locals()))
             run("CREATE DATABASE {database};".format(**locals()))
             run("GRANT ALL PRIVILEGES ON DATABASE {database} TO {user};".format(**locals()))
         else:
             click.echo("Warning: Don't know how to setup " + db_engine)
 
+    def clone_database(self, source, database, user, pwd, db_engine,
+                       source_user=None):
+        """Create database `database` as a copy of database `source`.
+
+        sqlite3 databases are files in the project directory and get copied
+        together with it.  PostgreSQL copies the data files server-side using
+        the source database as template (this fails while other sessions are
+        connected to the source database).  MySQL streams a dump directly
+        into the new database without writing it to disk.  The dump is done
+        by `source_user`, who must have the same password `pwd` as the new
+        user, so that the client programs don't ask for passwords.
+        """
+        if db_engine == 'sqlite3':
+            click.echo("No database clone needed for " + db_engine)
+        elif db_engine == 'mysql':
+            def run(cmd):
+                self.runcmd('mysql -u root -p -e "{};"'.format(cmd))
+            run("create user '{user}'@'localhost' identified by '{pwd}'".format(**locals()))
+            run("create database {database} charset 'utf8'".format(**locals()))
+            run("grant all PRIVILEGES on {database}.* to '{user}'@'localhost'".format(**locals()))
+            source_user = source_user or source
+            p = self.runcmd(
+                "set -o pipefail; mysqldump -u {source_user} --single-transaction "
+                "--no-tablespaces {source} | mysql -u {user} {database}".format(
+                    **locals()),
+                env=dict(os.environ, MYSQL_PWD=pwd), executable='/bin/bash')
+            if p is not None and p.returncode:
+                raise click.ClickException(
+                    "Failed to copy database {} to {}".format(source, database))
+        elif db_engine == 'postgresql':
+            def run(cmd):
+                assert '"' not in cmd
+                self.runcmd('sudo -u postgres psql -c "{}"'.format(cmd))
+            run("CREATE USER {user} WITH PASSWORD '{pwd}';".format(**locals()))
+            run("CREATE DATABASE {database} TEMPLATE {source} OWNER {user};".format(**locals()))
+            run("GRANT ALL PRIVILEGES ON DATABASE {database} TO {user};".format(**locals()))
+        else:
+            click.echo("Warning: Don't know how to clone " + db_engine)
+
     def run_apt_install(self):
         if len(self._system_packages) == 0:
             return
@@ -201,18 +506,21 @@ class Installer(object):
         cmd = "apt-get install "
         if self.batch:
             cmd += "-y "
-        self.runcmd(cmd + ' '.join(self._system_packages))
+        with locked('apt'):
+            self.runcmd(cmd + ' '.join(self._system_packages))
+        self._system_packages = set()
 
-    def install_repo(self, repo):
+    def install_repo(self, repo, env):
         if not os.path.exists(repo.nickname):
-            i.runcmd("git clone --depth 1 -b master {}".format(repo.git_repo))
-            i.run_in_env(envdir, "pip install -e {}".format(repo.nickname))
+            self.runcmd("git clone --depth 1 -b master {}".format(repo.git_repo))
+            self.pip_install(env, "-e {}".format(os.path.abspath(repo.nickname)))
         else:
             click.echo(
                 "Don't install {} because the code repository exists.".format(
                     repo.package_name))
 
     def finish(self):
+        self.run_pip_install()
         if not self.asroot:
             if len(self._system_packages):
                 click.echo(
@@ -221,17 +529,245 @@ class Installer(object):
             return
 
         self.run_apt_install()
+        with locked('services'):
+            self.restart_services()
+
+    def restart_services(self):
         if len(self._services):
             msg = "Restart services {}".format(self._services)
             if self.batch or click.confirm(msg, default=True):
                 with self.override_batch(True):
                     for srv in self._services:
                         self.runcmd("service {} restart".format(srv))
+        reload_services = self._reload_services - self._services
+        if len(reload_services):
+            msg = "Reload services {}".format(reload_services)
+            if self.batch or click.confirm(msg, default=True):
+                with self.override_batch(True):
+                    for srv in reload_services:
+                        cmd = RELOAD_COMMANDS.get(
+                            srv, "service {} reload".format(srv))
+                        self.runcmd(cmd)
+        if len(self._systemd_units):
+            # start new units, reload changed ones
+            with self.override_batch(True):
+                for unit in self._systemd_units:
+                    self.runcmd(
+                        "systemctl enable {0} && systemctl reload-or-restart {0}".format(unit))
+        self._services = set()
+        self._reload_services = set()
+        self._systemd_units = set()
+
+
+_held_locks = {}
+_held_locks_lock = threading.Lock()
+
+
+def lock_dir():
+    """Return the lock directory, creating it if needed.
+
+    All getlino processes on this server use the same directory, whoever
+    runs them, so that they exclude each other.  The directory belongs to
+    the user group, which may create lock files in it.
+    """
+    try:
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        si = os.stat(LOCK_DIR)
+        usergroup = DEFAULTSECTION.get('usergroup')
+        # older getlino versions created it writable only for its owner
+        if si.st_uid == os.getuid() and usergroup and (
+                group_name(si.st_gid) != usergroup
+                or stat.S_IMODE(si.st_mode) != 0o2775):
+            shutil.chown(LOCK_DIR, group=usergroup)
+            os.chmod(LOCK_DIR, 0o2775)
+    except (OSError, LookupError) as e:
+        raise click.ClickException(
+            "Cannot create lock directory {}: {}".format(LOCK_DIR, e))
+    return LOCK_DIR
+
+
+def open_lock_file(name):
+    """Open the lock file for the resource `name`.  The lock file is opened
+    for reading because flock doesn't need more, and lock files created by
+    another user may not be writable for us."""
+    pth = join(lock_dir(), name + '.lock')
+    try:
+        fd = os.open(pth, os.O_RDONLY | os.O_CREAT, 0o664)
+    except OSError as e:
+        raise click.ClickException(
+            "Cannot open lock file {}: {}.  Run getlino as root or as a "
+            "member of the group {}.".format(
+                pth, e, DEFAULTSECTION.get('usergroup')))
+    try:
+        # the umask may have removed the group write permission
+        os.fchmod(fd, 0o664)
+    except OSError:
+        # created by another user
+        pass
+    return os.fdopen(fd)
+
+
+@contextmanager
+def locked(name):
+    """Hold an exclusive advisory lock on the resource `name` while inside the
+    context.
+
+    Locks are held using :func:`fcntl.flock` on a file in the lock directory,
+    so they are released by the kernel when the process dies.  They are
+    reentrant: a process which already holds a lock can acquire it again.
+    """
+    with _held_locks_lock:
+        entry = _held_locks.setdefault(name, [threading.RLock(), None, 0])
+    with entry[0]:
+        if entry[2] == 0:
+            fd = open_lock_file(name)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                click.echo("Waiting for other getlino process to release {}".format(name))
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            entry[1] = fd
+        entry[2] += 1
+        try:
+            yield
+        finally:
+            entry[2] -= 1
+            if entry[2] == 0:
+                entry[1].close()
+                entry[1] = None
+
+
+def env_lock_name(envdir):
+    """Return the name of the lock for pip operations in the given
+    virtualenv."""
+    return 'env' + re.sub(r'\W', '_', os.path.realpath(envdir))
+
+
+def site_lock_name(prjname):
+    """Return the name of the lock for the project directory of a site."""
+    return 'site-' + prjname
+
+
+def process_manager():
+    """Return the name of the process manager used on this server."""
+    return DEFAULTSECTION.get('process_manager', 'supervisor')
+
+
+def program_reload_cmd(name):
+    """Return the shell command for gracefully reloading the program `name`
+    (which must support reloading on SIGHUP)."""
+    if process_manager() == 'systemd':
+        return "systemctl reload {}.service".format(name)
+    return "supervisorctl signal HUP {}".format(name)
+
+
+def program_is_running(name):
+    """Return True if the program `name` is running."""
+    if process_manager() == 'systemd':
+        cmd = ["systemctl", "is-active", "--quiet", name + ".service"]
+        return subprocess.run(cmd).returncode == 0
+    p = subprocess.run(["supervisorctl", "status", name],
+                       stdout=subprocess.PIPE, universal_newlines=True)
+    return "RUNNING" in p.stdout
+
+
+def resource_limits(values):
+    """Return a dict with the systemd resource limit directives for the
+    resource limit options in `values` (a dict or a config section)."""
+    limits = collections.OrderedDict()
+    for k, directive in RESOURCE_LIMITS.items():
+        v = values.get(k)
+        if v:
+            limits[directive] = v
+    return limits
+
+
+def site_packages_mtime(env):
+    """Return the time of the last change of the packages installed in the
+    given virtualenv.  Installing or removing a package changes the
+    site-packages directory."""
+    return max([os.path.getmtime(pth) for pth in
+                glob.glob(join(env, 'lib', 'python*', 'site-packages'))] or [0])
+
+
+def same_content(pth, content):
+    """Return True if the file `pth` exists and contains `content`."""
+    if not os.path.isfile(pth):
+        return False
+    with open(pth) as fd:
+        return fd.read() == content
+
+
+@functools.lru_cache(maxsize=None)
+def group_name(gid):
+    """Return the name of the group with the given id."""
+    return grp.getgrgid(gid).gr_name
 
 
 def check_usergroup(usergroup):
     for gid in os.getgroups():
-        if grp.getgrgid(gid).gr_name == usergroup:
+        if group_name(gid) == usergroup:
             return True
     return False
 
+
+
+Site = collections.namedtuple('Site', ('prjname', 'project_dir', 'envdir'))
+
+
+def env_environ(env):
+    """Return the environment variables for running a program of the
+    virtualenv `env`, i.e. those its activate script would set."""
+    environ = dict(os.environ, VIRTUAL_ENV=env, PATH=os.pathsep.join(
+        [join(env, 'bin'), os.environ.get('PATH', '')]))
+    environ.pop('PYTHONHOME', None)
+    return environ
+
+
+def manage_commands_args(env, commands):
+    """Return the arguments for running the given :xfile:`manage.py`
+    commands in a single process using the Python of virtualenv `env`."""
+    return [join(env, 'bin', 'python'), '-c', MANAGE_COMMANDS_SCRIPT,
+            json.dumps([list(c) for c in commands])]
+
+
+def run_site_commands(site, *commands):
+    """Run the given :xfile:`manage.py` commands on the given site in a
+    single process.
+
+    Return a tuple `(site, commands, returncode, output, seconds)`.  The
+    output contains the time used by every command.
+    """
+    started = time.time()
+    p = subprocess.run(
+        manage_commands_args(site.envdir, commands), cwd=site.project_dir,
+        env=env_environ(site.envdir), stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, universal_newlines=True)
+    return site, commands, p.returncode, p.stdout, time.time() - started
+
+
+def find_sites():
+    """Yield a tuple `(prjname, project_dir)` for every Lino site on this
+    server.  A site is a directory below the local prefix that contains a
+    :xfile:`manage.py` file."""
+    root = join(DEFAULTSECTION.get('projects_root'),
+                DEFAULTSECTION.get('local_prefix'))
+    if not os.path.isdir(root):
+        return
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if entry.is_dir() and os.path.exists(join(entry.path, 'manage.py')):
+            yield entry.name, entry.path
+
+
+def site_app(project_dir):
+    """Return the :class:`Repo` of the application running on the site in
+    `project_dir`, or `None` if it cannot be found in its settings."""
+    pth = join(project_dir, 'settings.py')
+    if not os.path.exists(pth):
+        return None
+    with open(pth) as fd:
+        content = fd.read()
+    for repo in KNOWN_REPOS:
+        if repo.settings_module and repo.settings_module in content:
+            return repo
+    return None
@@ -0,0 +1,150 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import ssl
+import time
+import socket
+import http.client
+import click
+from concurrent.futures import ThreadPoolExecutor
+
+from os.path import join
+
+from .utils import FOUND_CONFIG_FILES, DEFAULTSECTION
+from .utils import Site, find_sites, run_site_commands
+from .registry import get_sites
+
+
+def uwsgi_processes_count(site, default=4):
+    """Return the number of uwsgi workers configured for a site."""
+    pth = join(site.project_dir, 'nginx', '{}_uwsgi.ini'.format(site.prjname))
+    if os.path.exists(pth):
+        with open(pth) as fd:
+            for ln in fd:
+                k, _, v = ln.partition('=')
+                if k.strip() in ('processes', 'workers') and v.strip().isdigit():
+                    return int(v.strip())
+    return default
+
+
+def prime_request(domain, path, https, timeout=120):
+    """Send a GET request for `path` to the local web server as if it was
+    addressed to `domain`.  Return the HTTP status."""
+    if https:
+        ctx = ssl._create_unverified_context()
+        conn = http.client.HTTPSConnection(domain, 443, timeout=timeout)
+        # connect to this server but send the domain name in SNI and Host
+        conn.sock = ctx.wrap_socket(
+            socket.create_connection(('127.0.0.1', 443), timeout),
+            server_hostname=domain)
+    else:
+        conn = http.client.HTTPConnection('127.0.0.1', 80, timeout=timeout)
+    try:
+        conn.request('GET', path, headers={'Host': domain})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def site_is_ready(site, timeout=10):
+    """Return True if the web server and the uwsgi workers of a site answer
+    a request without a server error (e.g. 502 while uwsgi is reloading)."""
+    domain = "{}.{}".format(site.prjname, DEFAULTSECTION.get('server_domain'))
+    path = DEFAULTSECTION.get('warmup_urls', '/').split()[0]
+    try:
+        status = prime_request(domain, path, DEFAULTSECTION.getboolean('https'),
+                               timeout)
+    except (OSError, http.client.HTTPException):
+        return False
+    return status < 500
+
+
+def build_cache(site):
+    """Let Lino build the cache files of a site for all languages.
+
+    Return a tuple `(ok, output, seconds)`."""
+    site, commands, returncode, output, seconds = run_site_commands(
+        site, ['buildcache'])
+    return returncode == 0, output, seconds
+
+
+def prime_site(site, requests=None):
+    """Send priming requests to a site so that every uwsgi worker has
+    imported the code and filled its caches.
+
+    The requests go through nginx because the site stays in the nginx
+    rotation during a graceful reload of uwsgi: the requests which arrive
+    meanwhile wait in the queue of the uwsgi socket.
+
+    The requests are sent concurrently, so they get distributed among the
+    workers.  Return a list of `(path, status)`.
+    """
+    domain = "{}.{}".format(site.prjname, DEFAULTSECTION.get('server_domain'))
+    https = DEFAULTSECTION.getboolean('https')
+    paths = DEFAULTSECTION.get('warmup_urls', '/').split()
+    if not requests:
+        requests = 2 * uwsgi_processes_count(site)
+
+    def request(path):
+        try:
+            return path, prime_request(domain, path, https)
+        except (OSError, http.client.HTTPException) as e:
+            return path, str(e)
+
+    with ThreadPoolExecutor(max_workers=requests) as pool:
+        return list(pool.map(request, paths * requests))
+
+
+@click.command()
+@click.argument('prjnames', nargs=-1)
+@click.option('--parallel', default=os.cpu_count() or 1,
+              help="Maximum number of sites to warm up at the same time")
+@click.option('--requests', default=0,
+              help="Number of priming requests per URL (default is twice "
+                   "the number of uwsgi workers)")
+@click.option('--cache/--no-cache', default=True,
+              help="Whether to build the Lino cache files")
+def warmup(prjnames, parallel, requests, cache):
+    """
+    Prepare the sites for their first users.
+
+    Build the cache files of every site for all its languages, then send
+    priming requests to every site so that all uwsgi workers are warm.
+
+    Arguments:
+
+    PRJNAMES : The sites to warm up. Default is all sites.
+
+    """
+    if len(FOUND_CONFIG_FILES) == 0:
+        raise click.UsageError(
+            "This server is not yet configured. Did you run `sudo -H getlino configure`?")
+    env_link = DEFAULTSECTION.get('env_link')
+    sites = [Site(s.prjname, s.project_dir, s.envdir)
+             for s in get_sites(prjnames)]
+    if not sites:
+        sites = [Site(n, d, os.path.realpath(join(d, env_link)))
+                 for n, d in find_sites() if not prjnames or n in prjnames]
+
+    # the cache files must stay writable for the user group
+    os.umask(0o002)
+
+    def warm(site):
+        started = time.time()
+        if cache:
+            ok, output, seconds = build_cache(site)
+            if not ok:
+                return site, output, time.time() - started
+        results = prime_site(site, requests)
+        failed = [r for r in results if r[1] != 200]
+        msg = "{} requests".format(len(results))
+        if failed:
+            msg += ", {} failed: {}".format(len(failed), failed[0])
+        return site, msg, time.time() - started
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+        for site, msg, seconds in pool.map(warm, sites):
+            click.echo("{}: {} ({:.1f} seconds)".format(site.prjname, msg, seconds))
@@ -0,0 +1,141 @@
+# Copyright 2019 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+import re
+import time
+import datetime
+import subprocess
+import click
+
+from os.path import join
+
+WORKER_PACKAGES = "django-rq"
+
+# Inserted into the settings of a site with a worker pool before the Site
+# gets instantiated, because Lino sets INSTALLED_APPS when instantiating it.
+WORKER_APPS = """# added by getlino: the worker pool needs django_rq
+class Site(Site):
+    def get_installed_apps(self):
+        yield super(Site, self).get_installed_apps()
+        yield 'django_rq'
+
+
+"""
+
+# Added by older getlino versions, but Lino overrides it.
+OLD_WORKER_APPS = """if 'INSTALLED_APPS' in globals():
+    INSTALLED_APPS = tuple(INSTALLED_APPS) + ('django_rq',)
+"""
+
+# Appended to the settings of a site with a worker pool.  The queue has the
+# name of the site because all sites share the same redis database.
+# note that we double curly braces because we will run format() on this string:
+WORKER_SETTINGS = """
+# added by getlino: background jobs run by `{prjname}-worker`.  Enqueue them
+# using django_rq.get_queue(GETLINO_QUEUE).enqueue(func, *args)
+GETLINO_QUEUE = '{prjname}'
+RQ_QUEUES = {{
+    GETLINO_QUEUE: {{
+        'HOST': 'localhost',
+        'PORT': 6379,
+        'DB': 0,
+        'DEFAULT_TIMEOUT': 3600,
+    }},
+}}
+"""
+
+WORKER_COMMAND = "{envdir}/bin/python manage.py rqworker {prjname}"
+
+
+def default_worker_processes():
+    """Return the default size of the worker pool of a site.
+
+    Jobs are mostly waiting for the database, mail server or LibreOffice,
+    so we use half the CPUs, but at least one.
+    """
+    return max(1, (os.cpu_count() or 1) // 2)
+
+
+def worker_program(prjname):
+    return "{}-worker".format(prjname)
+
+
+def setup_worker(i, context, envdir, numprocs, **kwargs):
+    """Install the worker pool of a site and wire its settings.
+
+    `kwargs` are forwarded to :meth:`Installer.write_program_conf`.
+    """
+    project_dir = context['project_dir']
+    prjname = context['prjname']
+    i.pip_install(envdir, WORKER_PACKAGES)
+    pth = join(project_dir, 'settings.py')
+    with open(pth) as fd:
+        content = fd.read()
+    new = content.replace(OLD_WORKER_APPS, '')
+    if "yield 'django_rq'" not in new:
+        new, n = re.subn(r"(?m)^(?=SITE\s*=\s*Site\()",
+                         lambda m: WORKER_APPS, new, count=1)
+        if not n:
+            click.echo("Warning: found no `SITE = Site(...)` in {}, please "
+                       "add django_rq to the installed apps.".format(pth))
+    # don't append the block again when it has been edited
+    if 'GETLINO_QUEUE' not in new:
+        new += WORKER_SETTINGS.format(prjname=prjname)
+    if new != content:
+        with open(pth, 'w') as fd:
+            fd.write(new)
+    i.write_program_conf(
+        worker_program(prjname),
+        WORKER_COMMAND.format(envdir=envdir, prjname=prjname),
+        user=context['usergroup'], directory=project_dir,
+        numprocs=numprocs, **kwargs)
+
+
+def redis(*args):
+    p = subprocess.run(['redis-cli', '--raw'] + list(args),
+                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                       universal_newlines=True)
+    return p.stdout.strip()
+
+
+def parse_rq_time(s):
+    """Convert a timestamp as stored by rq into seconds since the epoch."""
+    if not s:
+        return None
+    s = s.rstrip('Z')
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in s else '%Y-%m-%dT%H:%M:%S'
+    dt = datetime.datetime.strptime(s, fmt).replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+def queue_stats(queue, sample=20):
+    """Return a dict with the state of the given rq queue: the number of
+    waiting jobs, the age of the oldest waiting job, and the average wait
+    and run times of the last `sample` finished jobs (in seconds)."""
+    stats = dict(depth=int(redis('LLEN', 'rq:queue:' + queue) or 0),
+                 oldest=None, wait=None, run=None)
+    now = time.time()
+    oldest = redis('LINDEX', 'rq:queue:' + queue, '0')
+    if oldest:
+        enqueued = parse_rq_time(redis('HGET', 'rq:job:' + oldest, 'enqueued_at'))
+        if enqueued:
+            stats['oldest'] = now - enqueued
+    waits = []
+    runs = []
+    finished = redis('ZREVRANGE', 'rq:finished:' + queue, '0', str(sample - 1))
+    for job in finished.split():
+        values = redis('HMGET', 'rq:job:' + job,
+                       'enqueued_at', 'started_at', 'ended_at').splitlines()
+        if len(values) != 3:
+            continue
+        enqueued, started, ended = [parse_rq_time(v) for v in values]
+        if enqueued and started:
+            waits.append(started - enqueued)
+        if started and ended:
+            runs.append(ended - started)
+    if waits:
+        stats['wait'] = sum(waits) / len(waits)
+    if runs:
+        stats['run'] = sum(runs) / len(runs)
+    return stats
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tarfile
+import tempfile
+from os.path import join
+
+import click
+from atelier.test import TestCase
+
+from getlino.bundle import check_member
+
+
+def member(name, type=tarfile.REGTYPE, linkname=''):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.linkname = linkname
+    return info
+
+
+class BundleTests(TestCase):
+    def test_check_member(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            dest = join(tmp, 'site')
+            os.makedirs(join(dest, 'media'))
+            check_member(member('settings.py'), dest)
+            check_member(member('media/x', tarfile.SYMTYPE, '../settings.py'), dest)
+            check_member(member('media/y', tarfile.LNKTYPE, 'settings.py'), dest)
+            for info in [
+                    member('/etc/passwd'),
+                    member('media/../../x'),
+                    member('x', tarfile.SYMTYPE, '/etc'),
+                    member('media/x', tarfile.SYMTYPE, '../../x'),
+                    member('x', tarfile.LNKTYPE, '/etc/passwd')]:
+                with self.assertRaises(click.ClickException):
+                    check_member(info, dest)
+            # a link extracted before must not be followed
+            os.symlink('/etc', join(dest, 'etc'))
+            with self.assertRaises(click.ClickException):
+                check_member(member('etc/cron.d/evil'), dest)
+        finally:
+            shutil.rmtree(tmp)
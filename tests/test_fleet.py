@@ -0,0 +1,58 @@
+import os
+import stat
+import shutil
+import tempfile
+from os.path import join
+
+from click.testing import CliRunner
+from atelier.test import TestCase
+
+from getlino.fleet import fleet, ssh_args
+
+# Stands in for ssh: ignores the options and runs the remote command
+# locally.  Fails for hosts named "bad".
+FAKE_SSH = """#!/bin/sh
+while [ $# -gt 2 ]; do shift; done
+[ "$1" = bad ] && exit 3
+echo "on $1"
+PATH={tmp}:$PATH sh -c "$2"
+"""
+
+FAKE_GETLINO = """#!/bin/sh
+echo "getlino $*"
+"""
+
+
+class FleetTests(TestCase):
+    def test_ssh_args(self):
+        args = ssh_args('joe@example.org:2222')
+        self.assertIn('ControlMaster=auto', args)
+        self.assertEqual(args[-3:], ['-p', '2222', 'joe@example.org'])
+
+    def test_fleet(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            for name, content in (('ssh', FAKE_SSH), ('getlino', FAKE_GETLINO)):
+                pth = join(tmp, name)
+                with open(pth, 'w') as fd:
+                    fd.write(content.format(tmp=tmp))
+                os.chmod(pth, stat.S_IRWXU)
+            inventory = join(tmp, 'hosts')
+            with open(inventory, 'w') as fd:
+                fd.write("# test hosts\none\ntwo:22\n")
+            result = CliRunner().invoke(fleet, [
+                '--inventory', inventory, '--hosts', 'three', '--no-sudo',
+                '--ssh-command', join(tmp, 'ssh'), '--',
+                'list', '--batch'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            for host in ('one', 'two:22', 'three'):
+                self.assertIn("on {}".format(host.split(':')[0]), result.output)
+            self.assertEqual(result.output.count("| getlino list --batch"), 3)
+
+            result = CliRunner().invoke(fleet, [
+                '--hosts', 'one,bad', '--no-sudo',
+                '--ssh-command', join(tmp, 'ssh'), 'status'])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("Failed on bad", result.output)
+        finally:
+            shutil.rmtree(tmp)
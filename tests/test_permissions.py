@@ -0,0 +1,52 @@
+import os
+import stat
+import shutil
+import tempfile
+from os.path import join
+
+from atelier.test import TestCase
+
+from getlino.permissions import fix_tree
+
+
+def mode(pth):
+    return stat.S_IMODE(os.lstat(pth).st_mode)
+
+
+class PermissionsTests(TestCase):
+    def test_fix_tree(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            root = join(tmp, 'site')
+            os.makedirs(join(root, 'media'))
+            os.chmod(root, 0o2775)
+            os.chmod(join(root, 'media'), 0o700)
+            with open(join(root, 'settings.py'), 'w'):
+                pass
+            os.chmod(join(root, 'settings.py'), 0o644)
+            with open(join(root, 'manage.py'), 'w'):
+                pass
+            os.chmod(join(root, 'manage.py'), 0o754)
+            with open(join(root, 'media', 'object'), 'w'):
+                pass
+            os.chmod(join(root, 'media', 'object'), 0o444)
+            outside = join(tmp, 'outside')
+            with open(outside, 'w'):
+                pass
+            os.chmod(outside, 0o600)
+            os.symlink(outside, join(root, 'link'))
+            gid = os.getgid()
+
+            # 5 entries besides the symlink, 3 of them need a change
+            self.assertEqual(fix_tree(root, gid, dry_run=True)[1:4], (5, 3, 0))
+            self.assertEqual(mode(join(root, 'media')), 0o700)
+            self.assertEqual(fix_tree(root, gid)[1:4], (5, 3, 0))
+            self.assertEqual(mode(join(root, 'media')), 0o2770)
+            self.assertEqual(mode(join(root, 'settings.py')), 0o664)
+            self.assertEqual(mode(join(root, 'manage.py')), 0o774)
+            self.assertEqual(mode(join(root, 'media', 'object')), 0o444)
+            self.assertEqual(mode(outside), 0o600)
+            # only entries which differ get changed
+            self.assertEqual(fix_tree(root, gid)[1:4], (5, 0, 0))
+        finally:
+            shutil.rmtree(tmp)
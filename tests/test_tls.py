@@ -0,0 +1,101 @@
+import shutil
+import tempfile
+import subprocess
+import unittest
+from os.path import join
+
+from atelier.test import TestCase
+
+from getlino.utils import DEFAULTSECTION
+from getlino.tls import tls_conf, tune_tls, system_nameservers
+
+NGINX_CONF = """
+pid {tmp}/nginx.pid;
+error_log {tmp}/error.log;
+events {{}}
+http {{
+    access_log off;
+    server {{
+        server_name example.org;
+        listen 8443 ssl;
+        ssl_certificate {tmp}/cert.pem;
+        ssl_certificate_key {tmp}/key.pem;
+        include /etc/letsencrypt/options-ssl-nginx.conf;
+    }}
+    server {{
+        server_name second.example.org;
+        listen 8443 ssl;
+        ssl_certificate {tmp}/cert.pem;
+        ssl_certificate_key {tmp}/key.pem;
+    }}
+}}
+"""
+
+
+CERTBOT_CONF = """
+server {
+    server_name example.org;
+    listen 443 ssl;
+    ssl_certificate /etc/letsencrypt/live/example.org/fullchain.pem;
+    ssl_certificate_key /etc/letsencrypt/live/example.org/privkey.pem;
+    include /etc/letsencrypt/options-ssl-nginx.conf;
+}
+"""
+
+
+class OcspTests(TestCase):
+    def test_ocsp_stapling(self):
+        DEFAULTSECTION['ocsp_stapling'] = 'true'
+        DEFAULTSECTION['ocsp_resolver'] = '192.0.2.1'
+        try:
+            conf = tls_conf()
+        finally:
+            DEFAULTSECTION['ocsp_resolver'] = ''
+        self.assertIn("ssl_stapling on;", conf)
+        self.assertIn("ssl_stapling_verify on;", conf)
+        self.assertIn("resolver 192.0.2.1 valid=300s;", conf)
+        content = tune_tls(CERTBOT_CONF, '/tmp/tls.conf')
+        self.assertIn(
+            "    include /tmp/tls.conf;\n    ssl_trusted_certificate "
+            "/etc/letsencrypt/live/example.org/chain.pem;", content)
+        self.assertEqual(tune_tls(content, '/tmp/tls.conf'), content)
+
+    def test_system_nameservers(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            pth = join(tmp, 'resolv.conf')
+            with open(pth, 'w') as fd:
+                fd.write("# comment\nnameserver 192.0.2.1\nnameserver ::1\n")
+            self.assertEqual(system_nameservers(pth), ['192.0.2.1', '[::1]'])
+            self.assertEqual(system_nameservers(join(tmp, 'missing')),
+                             ['127.0.0.53'])
+        finally:
+            shutil.rmtree(tmp)
+
+
+@unittest.skipUnless(shutil.which('nginx') and shutil.which('openssl'),
+                     "requires nginx and openssl")
+class TlsTests(TestCase):
+    def test_nginx_accepts_tls_snippet(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            subprocess.check_call([
+                'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                '-days', '1', '-subj', '/CN=example.org',
+                '-keyout', join(tmp, 'key.pem'), '-out', join(tmp, 'cert.pem')],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            snippet = join(tmp, 'tls.conf')
+            with open(snippet, 'w') as fd:
+                fd.write(tls_conf())
+            content = tune_tls(NGINX_CONF.format(tmp=tmp), snippet)
+            self.assertEqual(content.count('include ' + snippet), 2)
+            self.assertEqual(tune_tls(content, snippet), content)
+            conffile = join(tmp, 'nginx.conf')
+            with open(conffile, 'w') as fd:
+                fd.write(content)
+            p = subprocess.run(['nginx', '-t', '-p', tmp, '-c', conffile],
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+            self.assertEqual(p.returncode, 0, p.stdout)
+        finally:
+            shutil.rmtree(tmp)